@@ -1,13 +1,19 @@
 #! /usr/bin/env python
+import argparse
 import hashlib
 import os
 
 import pandas as pd
 
-from oct_utils.choroid import choroid_thickness_normal
+from oct_utils.conventions import normalize_alias
 from oct_utils.data_structures import PosteriorPoleData
-from oct_utils.interpolation import interpolate_3d
-from oct_utils.xml_parsing import extract_pp_map
+from oct_utils.ingestion import ingest_xml_dir, list_xml_series, series_fingerprint
+from oct_utils.progression import ProgressionMaps
+from oct_utils.quality_control import QualityGate
+from oct_utils.result_store import ResultStore
+from oct_utils.sharding import shard_of
+
+QC_REPORT_COLUMNS = ["alias", "eye", "age_acquired", "file_name", "file_md5", "reasons"]
 
 
 def clean_interp_values(interpolated_values):
@@ -20,41 +26,11 @@ def clean_interp_values(interpolated_values):
         del interpolated_values[alias]
 
 
-def interpolate_single_person(homedir, alias, chorthck_df: pd.DataFrame | None = None) -> {}:
-
-    interpolated_ppds = {}
-
-    for eye in ["OD", "OS"]:
-        eyedir = f"{homedir}/{alias}/{eye}"
-
-        pp_data = []
-        for xmlfile in [f for f in os.listdir(eyedir) if f[-4:] == ".xml"]:
-            ppd = extract_pp_map(f"{eyedir}/{xmlfile}")
-            if ppd is None: continue
-            ppd.filename = xmlfile
-            ppd.filename_md5 =  hashlib.md5(open(f"{eyedir}/{xmlfile}",'rb').read()).hexdigest()
-            ppd.choroid_ok = chorthck_df is None or choroid_thickness_normal(chorthck_df, alias, ppd.age_at_test, eye)
-            pp_data.append(ppd)
-
-        # sorted_ppds = sorted([pp for pp in pp_data if pp.choroid_ok], key=lambda ppd: ppd.age_at_test)
-        sorted_ppds = sorted([pp for pp in pp_data], key=lambda ppd: ppd.age_at_test)
-        interpolate_3d(sorted_ppds)
-        interpolated_ppds[eye] = pp_data
-
-    return interpolated_ppds
-
-
-def xml_files_to_interpolated_ppds(homedir: str,  chorthck_df: pd.DataFrame | None = None) -> (dict, dict):
-
-    aliases_w_post_pole = sorted(os.listdir(homedir))
-
-    interpolated_ppds = {}
-    for index, alias in enumerate(aliases_w_post_pole):
-        interp_ppds =  interpolate_single_person(homedir, alias, chorthck_df)
-        if not interp_ppds: continue # for example, we eliminated cases with excessive choroid thickness
-        interpolated_ppds[alias] = interp_ppds
-
-    return interpolated_ppds
+def xml_files_to_interpolated_ppds(homedir: str,  chorthck_df: pd.DataFrame | None = None,
+                                   codec: str | None = None, cache_dir: str | None = None,
+                                   quality_gate: QualityGate | None = None) -> dict:
+    # reading, parsing and interpolation overlap - see oct_utils.ingestion
+    return ingest_xml_dir(homedir, chorthck_df, codec=codec, cache_dir=cache_dir, quality_gate=quality_gate)
 
 
 def interpolate_dir_to_df(data_dir) -> pd.DataFrame:
@@ -73,16 +49,96 @@ def interpolate_dir_to_df(data_dir) -> pd.DataFrame:
     return output_df
 
 
+def interpolate_dir_to_store(data_dir: str, store: ResultStore, cache_dir: str | None = None,
+                             quality_gate: QualityGate | None = None, resume: bool = False,
+                             shard: tuple[int, int] | None = None, n_workers: int | None = None) -> int:
+
+    # each alias/eye series is committed to the store as soon as it is done, so a crash
+    # loses at most the series in flight; with resume, the series committed before
+    # (and whose files have not changed since) are skipped
+    all_series = list_xml_series(data_dir)
+    series = all_series
+    if shard is not None:
+        # (shard, n_shards): only the aliases of this shard
+        series = {key: paths for key, paths in all_series.items() if shard_of(key[0], shard[1]) == shard[0]}
+    fingerprints = {key: series_fingerprint(paths) for key, paths in series.items()}
+    if quality_gate is not None:
+        # a series stored under other QC settings is not what this run would store
+        fingerprints = {key: hashlib.md5(f"{fingerprint}:qc:{quality_gate.fingerprint()}".encode()).hexdigest()
+                        for key, fingerprint in fingerprints.items()}
+    skip_series = set(all_series) - set(series)
+    if resume:
+        completed = store.completed_series()
+        stored = {key for key, fingerprint in fingerprints.items() if completed.get(key) == fingerprint}
+        print(f"resuming: {len(stored)} of {len(fingerprints)} series in {data_dir} already stored")
+        skip_series |= stored
+
+    number_stored = 0
+    def checkpoint(series_key, ppds, complete):
+        nonlocal number_stored
+        (alias_dir, eye) = series_key
+        number_stored += store.commit_series(alias_dir, eye, ppds, fingerprints[series_key] if complete else None)
+
+    # the maps stay in the store's compact encoding all the way from the workers
+    codec = None if store.codec == "f8" else store.codec
+    ingest_xml_dir(data_dir, n_workers=n_workers, codec=codec, cache_dir=cache_dir, quality_gate=quality_gate,
+                   skip_series=skip_series, on_series=checkpoint)
+    return number_stored
+
+
+def write_qc_report(report_path: str, quality_gate: QualityGate | None, resume: bool = False):
+    """
+    The scans rejected by QC, one row each. With resume, the rows of an earlier report are kept
+    for the series this run has not checked again (i.e. skipped as already stored).
+    """
+    report_df = pd.DataFrame(quality_gate.report_rows() if quality_gate else [], columns=QC_REPORT_COLUMNS)
+    if resume and quality_gate is not None and os.path.exists(report_path):
+        previous_df = pd.read_excel(report_path, index_col=0)
+        checked = {(normalize_alias(alias), eye) for alias, eye in quality_gate.checked_series}
+        not_checked = [(normalize_alias(str(alias)), eye) not in checked
+                       for alias, eye in zip(previous_df["alias"], previous_df["eye"])]
+        report_df = pd.concat([previous_df[not_checked], report_df], ignore_index=True)
+    report_df.to_excel(report_path)
+
+
+def interpolate_group(top_level_dir: str, scratch_dir: str, data_group: str, codec: str = "auto",
+                      resume: bool = False, shard: tuple[int, int] | None = None, n_workers: int | None = None,
+                      qc: bool = False, qc_choroid: bool = False):
+    # "auto": whole micrometres (int16) for the maps as exported, float32 for the interpolated ones
+    # n_workers: parser/interpolation processes (default: one per CPU); less when other stages run alongside
+    # qc: drop the scans failing quality control (see oct_utils.quality_control); qc_choroid: also those
+    # whose choroid_ok flag is off
+    data_dir = f"{top_level_dir}/{data_group}"
+    db_path = f"{scratch_dir}/oct_results.{data_group}.sqlite"
+    # the series whose files have not changed since the last run are not interpolated again
+    cache_dir = f"{scratch_dir}/interpolation_cache"
+    quality_gate = QualityGate(check_choroid=qc_choroid) if qc else None
+    with ResultStore(db_path, codec=codec) as store:
+        number_stored = interpolate_dir_to_store(data_dir, store, cache_dir, quality_gate, resume, shard, n_workers)
+        # visit-to-visit changes of the interpolated maps, all series at once, stored for scoring and rendering
+        number_progression = store.upsert_progression(ProgressionMaps.from_ppds(store.query_ppds()))
+    print(f"stored {number_stored} scans in {db_path}")
+    print(f"stored the progression maps of {number_progression} scans")
+    if quality_gate is not None:
+        print(f"{len(quality_gate.rejected)} of {quality_gate.number_checked} scans failed QC")
+    # written (empty) without QC too, so that it never describes an earlier run with other settings
+    write_qc_report(f"{scratch_dir}/qc_rejections.{data_group}.xlsx", quality_gate, resume)
+
+
 def main():
     top_level_dir  = f"/media/ivana/portable/ush2a/oct/xml"
     scratch_dir = "/home/ivana/scratch/ush2a_oct"
 
-    for data_group in ["patients", "controls"]:
-        data_dir = f"{top_level_dir}/{data_group}"
-        output_df = interpolate_dir_to_df(data_dir)
-        output_df.to_excel(f"{scratch_dir}/interpolated_maps.{data_group}.xlsx")
-
+    parser = argparse.ArgumentParser(description="Parse and interpolate the xml exports into the result stores.")
+    parser.add_argument("--resume", action="store_true", help="skip the series stored by an earlier (interrupted) run")
+    parser.add_argument("--qc", action="store_true", help="drop the scans failing quality control")
+    parser.add_argument("--qc-choroid", action="store_true",
+                        help="with --qc, also drop the scans whose choroid_ok flag is off")
+    args = parser.parse_args()
 
+    for data_group in ["patients", "controls"]:
+        interpolate_group(top_level_dir, scratch_dir, data_group, resume=args.resume,
+                          qc=args.qc, qc_choroid=args.qc_choroid)
 
 
 #######################
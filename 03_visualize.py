@@ -1,29 +1,68 @@
 #! /usr/bin/env python
+import argparse
 import os
 
-import pandas as pd
+from oct_utils.plotting import plot_thickness_map, thickness_map_name
+from oct_utils.result_store import ResultStore
+from oct_utils.thumbnails import write_progression_thumbnails, write_thumbnails
+from oct_utils.verification import DeferredMd5Check
 
-from oct_utils.data_structures import PosteriorPoleData
-from oct_utils.plotting import plot_thickness_map
+
+def thumbnail_group(top_level_dir: str, scratch_dir: str, data_group: str):
+    """ The same maps as visualize_group, as plain thumbnails (no axes or colorbar), for browsing the QA. """
+    orig_dir = f"{scratch_dir}/pp_thumbnails/{data_group}/original"
+    intrp_dir = f"{scratch_dir}/pp_thumbnails/{data_group}/interpolated"
+    os.makedirs(orig_dir, exist_ok=True)
+    progr_dir = f"{scratch_dir}/pp_thumbnails/{data_group}/progression"
+    os.makedirs(intrp_dir, exist_ok=True)
+    os.makedirs(progr_dir, exist_ok=True)
+    with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+        ppds = store.query_ppds()
+        progression = store.query_progression()
+    with DeferredMd5Check() as md5_check:
+        for ppd in ppds:
+            md5_check.submit(ppd, f"{top_level_dir}/{data_group}",
+                             outputs=[f"{orig_dir}/{thickness_map_name(ppd, 'original')}",
+                                      f"{intrp_dir}/{thickness_map_name(ppd, 'interp')}",
+                                      f"{progr_dir}/{thickness_map_name(ppd, 'rate_baseline')}"])
+        write_thumbnails(ppds, orig_dir, thck_map="original")
+        write_thumbnails(ppds, intrp_dir, thck_map="interp")
+        number_progression = write_progression_thumbnails(ppds, progression, progr_dir, "rate_baseline")
+    print(f"wrote {2 * len(ppds) + number_progression} thumbnails to {scratch_dir}/pp_thumbnails/{data_group}")
+
+
+def visualize_group(top_level_dir: str, scratch_dir: str, data_group: str):
+    orig_dir = f"{scratch_dir}/pp_visualization/{data_group}/original"
+    intrp_dir = f"{scratch_dir}/pp_visualization/{data_group}/interpolated"
+    os.makedirs(orig_dir, exist_ok=True)
+    os.makedirs(intrp_dir, exist_ok=True)
+    data_dir = f"{top_level_dir}/{data_group}"
+    with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+        ppds = store.query_ppds()
+    with DeferredMd5Check() as md5_check:
+        for ppd in ppds:
+            print(f"{ppd.alias} {ppd.laterality} {ppd.age_at_test}")
+            # a corrupted file does not leave its figures behind (see DeferredMd5Check)
+            md5_check.submit(ppd, data_dir, outputs=[f"{orig_dir}/{thickness_map_name(ppd, 'original')}",
+                                                     f"{intrp_dir}/{thickness_map_name(ppd, 'interp')}"])
+            plot_thickness_map(ppd, orig_dir, thck_map="original")
+            plot_thickness_map(ppd, intrp_dir, thck_map="interp")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Thickness map figures of the scans in the result stores.")
+    parser.add_argument("--thumbnails", action="store_true",
+                        help="fast thumbnails for browsing, instead of the matplotlib figures")
+    args = parser.parse_args()
+
     top_level_dir = f"/media/ivana/portable/ush2a/oct/xml"
     scratch_dir   = "/home/ivana/scratch/ush2a_oct"
 
     for data_group in ["controls", "patients"]:
-        oct_df = pd.read_excel(f"{scratch_dir}/interpolated_maps.{data_group}.xlsx")
-        orig_dir = f"{scratch_dir}/pp_visualization/{data_group}/original"
-        intrp_dir = f"{scratch_dir}/pp_visualization/{data_group}/interpolated"
-        os.makedirs(orig_dir, exist_ok=True)
-        os.makedirs(intrp_dir, exist_ok=True)
-        data_dir = f"{top_level_dir}/{data_group}"
-        for index_value in oct_df.index:
-            print(f"Index: {index_value}")
-            ppd = PosteriorPoleData()
-            ppd.pd_dataframe_read(oct_df, index_value, fussy=True, xml_dir_path=data_dir)
-            plot_thickness_map(ppd, orig_dir, thck_map="original")
-            plot_thickness_map(ppd, intrp_dir, thck_map="interp")
+        if args.thumbnails:
+            thumbnail_group(top_level_dir, scratch_dir, data_group)
+        else:
+            visualize_group(top_level_dir, scratch_dir, data_group)
 
 #######################
 if __name__ == "__main__":
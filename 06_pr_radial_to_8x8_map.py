@@ -9,17 +9,15 @@ converts it to an 8x8 Cartesian grid using 2D interpolation.
 
 import numpy as np
 import pandas as pd
-from scipy.interpolate import griddata
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
 
+from oct_utils.reference_data import load_reference_sheet
 from oct_utils.visualization import plot_results
 
 quadrants = ['superior', 'inferior', 'temporal', 'nasal']
 
 def read_radial_data(filename:str, sheet_name: str, max_radius: float | None = None) -> pd.DataFrame:
     """
-    Read radial measurement data from Excel file.
+    Read radial measurement data from Excel file (through its cached binary copy, see oct_utils.reference_data).
 
     Parameters:
     -----------
@@ -31,7 +29,7 @@ def read_radial_data(filename:str, sheet_name: str, max_radius: float | None = N
     pd.DataFrame
         DataFrame with columns: mm, deg, superior, inferior, temporal, nasal
     """
-    df = pd.read_excel(filename, sheet_name=sheet_name)
+    df = load_reference_sheet(filename, sheet_name)
     if max_radius is not None:
         df = df[df.mm < max_radius]
     # some messup with reading xls (the old spreadsheet format)
@@ -139,6 +137,9 @@ def create_radial_points(df, max_radius_mm=None):
     return np.array(points), np.array(values)
 
 def plot_radial_heatmap(df, logcolors=False):
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+
     points, values = create_radial_points(df)
     values = np.asarray(values, dtype=float)
     x = np.array([p[0] for p in points], dtype=float)
@@ -201,6 +202,8 @@ def interpolate_to_grid(points, values, xi, yi, max_radius_mm=None):
     array
         Interpolated values on grid
     """
+    from scipy.interpolate import griddata
+
     # Use linear interpolation with nearest-neighbor extrapolation
     grid_values = griddata(points, values, (xi, yi),
                            method='linear', fill_value=0)
@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 """
 Combine rod and cone densities into a weight map for weighted avf retinal thickness scoring
+
+    ./07_pr_desnity_to_weights.py                     # the physiological weights, as set in create_weights_map
+    ./07_pr_desnity_to_weights.py --sweep             # rank a grid of candidate weight maps on the stored cohort
+    ./07_pr_desnity_to_weights.py --sweep --write-best   # ... and score with the best of them from now on
+                                                         # (data/selected_weights.json; delete it to go back)
 """
+import argparse
 import json
 
 import numpy as np
 import pandas as pd
-from scipy.interpolate import griddata
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.colors as colors
 
+from oct_utils.cohort import series_labels, stack_ages, stack_maps
+from oct_utils.result_store import ResultStore
+from oct_utils.stats import scheme_weights
 from oct_utils.visualization import plot_results
+from oct_utils.weight_sweep import SWEEP_METRICS, batch_scores, progression_t, separation, sweep_weight_maps
 
 quadrants = ['superior', 'inferior', 'temporal', 'nasal']
 
@@ -35,7 +41,20 @@ def create_weights_map(interpolated_df, cell_size_mm, cells_per_side, plot=False
     # Apply min-max normalization to new range [2, 100]
     normalized_weight_df = a + (weight_df - weight_df_min) * (b - a) / (weight_df_max - weight_df_min)
 
-    with open("data/physiological_weights.json", "w") as outf:
+    write_weights(normalized_weight_df, cell_size_mm, cells_per_side,
+                  relative_contribution_rods, relative_contribution_cones, [a, b])
+
+    if plot:
+        half_size = (cells_per_side * cell_size_mm) / 2
+        extent = [-half_size, half_size, -half_size, half_size]
+        output_file = ""
+        # output_file = "figures/weights_grid.png"
+        plot_results(normalized_weight_df, extent, cell_size_mm, output_file)
+
+
+def write_weights(weights, cell_size_mm, cells_per_side, relative_contribution_rods, relative_contribution_cones,
+                  weight_range, out_path="data/physiological_weights.json"):
+    with open(out_path, "w") as outf:
         optm_data = {
             "parameters": {
                 "cell_size_mm": cell_size_mm,
@@ -43,23 +62,13 @@ def create_weights_map(interpolated_df, cell_size_mm, cells_per_side, plot=False
             },
             "relative_contribution_rods": relative_contribution_rods,
             "relative_contribution_cones": relative_contribution_cones,
-            "range": [a, b],
-            "weights": np.asarray(normalized_weight_df).astype(np.int8).tolist()
+            "range": weight_range,
+            "weights": np.asarray(weights).astype(np.int8).tolist()
         }
         json.dump(optm_data, outf)
 
-    if plot:
-        half_size = (cells_per_side * cell_size_mm) / 2
-        extent = [-half_size, half_size, -half_size, half_size]
-        output_file = ""
-        # output_file = "figures/weights_grid.png"
-        plot_results(normalized_weight_df, extent, cell_size_mm, output_file)
 
-
-def main():
-    plot = True
-    cell_size_mm   = 0.86
-    cells_per_side = 8
+def densities_to_weights(cell_size_mm, cells_per_side, plot=False):
     interpolated_df = {}
     for density_map in ["cones_per_sq_mm", "rods_per_sq_mm"]:
         interpolated_df[density_map] = pd.read_csv(f"data/{density_map}.csv")
@@ -67,5 +76,76 @@ def main():
     create_weights_map(interpolated_df, cell_size_mm, cells_per_side, plot=plot)
 
 
+def load_cohort(scratch_dir: str, data_group: str) -> tuple[np.ndarray, np.ndarray, list]:
+    """ Interpolated maps, ages and series labels of a stored data group. """
+    with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+        ppds = store.query_ppds()
+        return stack_maps(ppds), stack_ages(ppds), series_labels(ppds)
+
+
+def sweep_weights(scratch_dir: str, cell_size_mm, cells_per_side, rank_by: str = "separation",
+                  write_best: bool = False) -> pd.DataFrame:
+    """
+    Score the cohort with every candidate of the sweep (see oct_utils.weight_sweep), and rank the candidates.
+    The current physiological weights and the uniform 8x8 weights are ranked along, for reference.
+    """
+    rods = pd.read_csv("data/rods_per_sq_mm.csv").to_numpy()
+    cones = pd.read_csv("data/cones_per_sq_mm.csv").to_numpy()
+    parameters, candidates = sweep_weight_maps(rods, cones)
+    parameters += [{"normalization": "current physiological"}, {"normalization": "uniform 8x8"}]
+    candidates = np.concatenate([candidates, scheme_weights("physiological")[None], scheme_weights("8x8")[None]])
+
+    (control_maps, control_ages, _) = load_cohort(scratch_dir, "controls")
+    (patient_maps, patient_ages, patient_series) = load_cohort(scratch_dir, "patients")
+    control_scores = batch_scores(control_maps, candidates)  # (number of scans, number of candidates)
+    patient_scores = batch_scores(patient_maps, candidates)
+
+    ranking = pd.DataFrame(parameters)
+    ranking["separation"] = separation(control_scores, control_ages, patient_scores, patient_ages)
+    ranking["progression_t"] = progression_t(patient_scores, patient_ages, patient_series)
+    ranking["weights"] = [json.dumps(weights.astype(int).tolist()) for weights in candidates]
+    # thinning shows as a negative slope: the most negative t is the clearest progression
+    ascending = rank_by == "progression_t"
+    ranking = ranking.sort_values(rank_by, ascending=ascending, ignore_index=True)
+    out_path = f"{scratch_dir}/weights_sweep.xlsx"  # the cohort's results stay with the cohort
+    ranking.to_excel(out_path)
+    print(f"{len(candidates)} weight maps scored on {len(control_ages)} control and {len(patient_ages)} patient scans")
+    print(ranking.drop(columns="weights").head(10).to_string())
+    print(f"wrote {out_path}")
+
+    if write_best:
+        best = ranking.iloc[0]
+        if best["normalization"] in ["current physiological", "uniform 8x8"]:
+            print(f"the best weights by {rank_by} are the {best['normalization']} ones - nothing written")
+        else:
+            # a file of its own, which the physiological_weights stage of the pipeline never overwrites
+            write_weights(json.loads(best["weights"]), cell_size_mm, cells_per_side,
+                          best["rod_fraction"], round(1 - best["rod_fraction"], 6),
+                          [best["range_low"], best["range_high"]], out_path="data/selected_weights.json")
+            print(f"wrote data/selected_weights.json ({best['normalization']}, rod fraction {best['rod_fraction']}, "
+                  f"range {best['range_low']}-{best['range_high']}); the scoring uses them instead of "
+                  f"data/physiological_weights.json from now on")
+    return ranking
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sweep", action="store_true", help="rank candidate weight maps on the stored cohort")
+    parser.add_argument("--rank-by", choices=SWEEP_METRICS, default="separation")
+    parser.add_argument("--write-best", action="store_true",
+                        help="write the best candidate to data/selected_weights.json, for the scoring to use "
+                             "instead of data/physiological_weights.json")
+    parser.add_argument("--scratch-dir", default="/home/ivana/scratch/ush2a_oct")
+    args = parser.parse_args()
+
+    plot = True
+    cell_size_mm   = 0.86
+    cells_per_side = 8
+    if args.sweep:
+        sweep_weights(args.scratch_dir, cell_size_mm, cells_per_side, args.rank_by, args.write_best)
+    else:
+        densities_to_weights(cell_size_mm, cells_per_side, plot=plot)
+
+
 if __name__ == "__main__":
     main()
@@ -1,12 +1,20 @@
 #! /usr/bin/env python
 import os
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from oct_utils.data_structures import PosteriorPoleData
-from oct_utils.stats import weighted_avg
+from oct_utils.bootstrap import ppd_confidence_intervals
+from oct_utils.cohort import stack_ages, stack_maps
+from oct_utils.normative import NormativeReference, controls_fingerprint
+from oct_utils.progression import PROGRESSION_MAPS, ProgressionMaps
+from oct_utils.result_store import ResultStore
+from oct_utils.stats import scheme_weights, weighted_avg_stack
+from oct_utils.trajectory import TrajectoryModel
+from oct_utils.verification import DeferredMd5Check
+
+def plot(df_dict, x_column: str, y_column_1: str, y_column_2: str, outfnm: str, show: bool = True) :
+    import matplotlib.pyplot as plt
 
-def plot(df_dict, x_column: str, y_column_1: str, y_column_2: str, outfnm: str) :
     fig, axes = plt.subplots(nrows=1, ncols=2, sharey=True, figsize=(10, 5))
 
      # Scatter plot y_column_1 vs x_column in first panel
@@ -23,8 +31,9 @@ def plot(df_dict, x_column: str, y_column_1: str, y_column_2: str, outfnm: str)
     df = df_dict["patients"]
     colors = ["yellowgreen", "orange", "red", "cyan", "gold", "purple", "teal"]
 
-    for idx, alias in enumerate (df["alias"].unique()):
-        alias_df = df[df["alias"] == alias].sort_values(by=x_column, ascending=True)
+    for idx, (patient_id, alias_df) in enumerate(df.groupby("patient_id", sort=False)):
+        alias_df = alias_df.sort_values(by=x_column, ascending=True)
+        alias = alias_df["alias"].iloc[0]
 
         axes[0].plot(alias_df[x_column], alias_df[y_column_1], color=colors[idx])
         axes[0].scatter(alias_df[x_column], alias_df[y_column_1], color=colors[idx], label=alias)
@@ -40,30 +49,135 @@ def plot(df_dict, x_column: str, y_column_1: str, y_column_2: str, outfnm: str)
     axes[1].set_ylabel(y_column_2)
     # axes[1].legend()
 
-    # plt.savefig(outfnm)
-    # print(f"plot written to {outfnm}")
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.savefig(outfnm)
+        print(f"plot written to {outfnm}")
+        plt.close()
+
+def report_trajectories(scores_df: pd.DataFrame, data_group: str):
+    # both scores against age, across the whole group, one series per alias/eye
+    labels = list(zip(scores_df["patient_id"], scores_df["eye"]))
+    for column in ["avg_thickness", "wtd_avg_thickness"]:
+        model = TrajectoryModel().fit(scores_df["age_acquired"], scores_df[column], labels)
+        mean_slope, sem = model.slope_summary()
+        print(f"{data_group} {column}: cohort slope {float(model.cohort_slope):.2f} μm/year; "
+              f"per-series slopes {float(mean_slope):.2f} ± {float(sem):.2f} μm/year")
+
+
+def compare_to_norms(reference: NormativeReference, ppds: list) -> pd.DataFrame:
+    zscores = reference.zscores(stack_maps(ppds), stack_ages(ppds))
+    return pd.DataFrame({
+        "alias": [ppd.alias for ppd in ppds],
+        "eye": [ppd.laterality for ppd in ppds],
+        "age_acquired": stack_ages(ppds),
+        "file_md5": [ppd.filename_md5 for ppd in ppds],
+        "mean_zscore": np.nanmean(zscores, axis=(1, 2)),
+        "cells_below_2sd": np.sum(zscores < -2, axis=(1, 2)),
+    })
+
+
+def progression_report(ppds: list, progression: ProgressionMaps) -> pd.DataFrame:
+    """ Weighted averages of the stored progression maps of each scan, in um (delta) and um/year (rate). """
+    weights = {weight_type: scheme_weights(weight_type) for weight_type in ["8x8", "physiological"]}
+    with np.errstate(invalid="ignore", divide="ignore"):  # no previous visit: all NaN
+        averages = {f"{map_name}_{weight_type}": weighted_avg_stack(getattr(progression, map_name), weight_map)
+                    for map_name in PROGRESSION_MAPS for weight_type, weight_map in weights.items()}
+    row_of = {file_md5: i for i, file_md5 in enumerate(progression.file_md5s)}
+    rows = []
+    for ppd in ppds:
+        if ppd.filename_md5 not in row_of: continue
+        i = row_of[ppd.filename_md5]
+        rows.append({"alias": ppd.alias, "eye": ppd.laterality, "age_acquired": ppd.age_at_test,
+                     "file_md5": ppd.filename_md5, "previous_md5": progression.previous_md5s[i],
+                     "years_since_previous": progression.years_since_previous[i],
+                     "years_since_baseline": progression.years_since_baseline[i],
+                     **{column: round(float(values[i]), 2) for column, values in averages.items()}})
+    return pd.DataFrame(rows)
+
+
+def score_group(top_level_dir: str, scratch_dir: str, data_group: str, reports: bool = True,
+                n_workers: int | None = None) -> pd.DataFrame:
+    data_dir = f"{top_level_dir}/{data_group}"
+    with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+        ppds = store.query_ppds()
+        # only the interpolated maps get decoded here, straight from the stored blobs into one array
+        maps = stack_maps(ppds)
+        avg_thickness = weighted_avg_stack(maps, scheme_weights("8x8"))
+        wtd_avg_thickness = weighted_avg_stack(maps, scheme_weights("physiological"))
+        with DeferredMd5Check() as md5_check:
+            for ppd, avg, wtd_avg in zip(ppds, avg_thickness, wtd_avg_thickness):
+                print(f"{ppd.alias} {ppd.laterality} {ppd.age_at_test}")
+                md5_check.submit(ppd, data_dir)
+                ppd.avg_thickness = round(float(avg)*1000)
+                ppd.wtd_avg_thickness = round(float(wtd_avg)*1000)
+        store.upsert_scores(ppds)
+        scores_df = store.query_scores()
+    # a shard (see run_shards.py) leaves the reports to the merge, which writes them for the whole group
+    if reports: write_score_reports(scratch_dir, data_group, ppds, scores_df, n_workers)
+    return scores_df
+
+
+def write_score_reports(scratch_dir: str, data_group: str, ppds: list | None = None,
+                        scores_df: pd.DataFrame | None = None, n_workers: int | None = None):
+    # n_workers: processes for the confidence intervals (default: one per CPU)
+    with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+        if ppds is None or scores_df is None:
+            ppds = store.query_ppds()
+            scores_df = store.query_scores()
+        # as stored by 02_interpolate, not recomputed
+        progression = store.query_progression()
+    scores_df.to_excel(f"{scratch_dir}/avg_retinal_thickness.{data_group}.xlsx")
+    progression_report(ppds, progression).to_excel(f"{scratch_dir}/progression_scores.{data_group}.xlsx")
+    # in mm, as returned by weighted_avg
+    intervals = ppd_confidence_intervals(ppds, weight_types=["8x8", "physiological"], n_workers=n_workers)
+    intervals.to_excel(f"{scratch_dir}/score_confidence_intervals.{data_group}.xlsx")
+    report_trajectories(scores_df, data_group)
+
+
+def build_normative_reference(scratch_dir: str) -> NormativeReference:
+    with ResultStore(f"{scratch_dir}/oct_results.controls.sqlite") as store:
+        reference = NormativeReference.from_ppds(store.query_ppds())
+    reference.save(f"{scratch_dir}/normative_reference.npz")
+    return reference
+
+
+def load_normative_reference(scratch_dir: str) -> NormativeReference:
+    """ The saved reference; (re)built if there is none, or the controls have changed since it was built. """
+    reference_path = f"{scratch_dir}/normative_reference.npz"
+    with ResultStore(f"{scratch_dir}/oct_results.controls.sqlite") as store:
+        fingerprint = controls_fingerprint(store.file_md5s())
+    if os.path.exists(reference_path):
+        try:
+            return NormativeReference.load(reference_path, fingerprint)
+        except ValueError as e:
+            print(f"Warning: {e}, rebuilding it")
+    return build_normative_reference(scratch_dir)
+
+
+def compare_groups(scratch_dir: str, show: bool = True):
+    reference = load_normative_reference(scratch_dir)
+    scores = {}
+    for data_group in ["controls", "patients"]:
+        with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+            scores[data_group] = store.query_scores()
+            if data_group == "patients":
+                zscores_df = compare_to_norms(reference, store.query_ppds())
+                zscores_df.to_excel(f"{scratch_dir}/normative_zscores.patients.xlsx")
+
+    plot(scores, "age_acquired", "avg_thickness", "wtd_avg_thickness", f"{scratch_dir}/avg_thckns.png", show=show)
+
 
 def main():
     top_level_dir = f"/media/ivana/portable/ush2a/oct/xml"
     scratch_dir   = "/home/ivana/scratch/ush2a_oct"
-    output_columns = ['alias', 'eye', 'age_acquired', 'avg_thickness', 'wtd_avg_thickness', 'file_name', 'file_md5']
 
-    output_df = {}
     for data_group in ["controls", "patients"]:
-        output_df[data_group] = pd.DataFrame(columns=output_columns)
-        oct_df = pd.read_excel(f"{scratch_dir}/interpolated_maps.{data_group}.xlsx")
-        data_dir = f"{top_level_dir}/{data_group}"
-        for index_value in oct_df.index:
-            print(f"Index: {index_value}")
-            ppd = PosteriorPoleData()
-            ppd.pd_dataframe_read(oct_df, index_value, fussy=True, xml_dir_path=data_dir)
-            ppd.avg_thickness = round(weighted_avg(ppd, interp=True, weight_type="8x8")*1000)
-            ppd.wtd_avg_thickness = round(weighted_avg(ppd, interp=True, weight_type="physiological")*1000)
-            ppd.pd_df_store_minimal(output_df[data_group])
-        output_df[data_group].to_excel(f"{scratch_dir}/avg_retinal_thickness.{data_group}.xlsx")
-
-    plot(output_df, "age_acquired", "avg_thickness", "wtd_avg_thickness", f"{scratch_dir}/avg_thckns.png")
+        score_group(top_level_dir, scratch_dir, data_group)
+
+    # the control norms are built once, and rebuilt whenever the controls change
+    compare_groups(scratch_dir)
 
 #######################
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+"""
+Startup benchmark: the time it takes to import each entry point, in a fresh interpreter,
+and which of the heavy dependencies the import drags in.
+
+    benchmarks/import_time.py                          # all entry points, best of 5
+    benchmarks/import_time.py oct_utils.stats 08_score --repeats 10
+    benchmarks/import_time.py --history scratch/import_times.jsonl --max-seconds 1.0
+
+With --history, one json line per entry point is appended to the file, so the numbers
+can be compared across commits. With --max-seconds, the exit status is 1 if any entry
+point takes longer than that to import.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["pandas", "scipy", "matplotlib"]
+ENTRY_POINTS = [
+    "oct_utils.data_structures",
+    "oct_utils.xml_parsing",
+    "oct_utils.interpolation",
+    "oct_utils.ingestion",
+    "oct_utils.result_store",
+    "oct_utils.stats",
+    "oct_utils.bootstrap",
+    "oct_utils.normative",
+    "oct_utils.trajectory",
+    "oct_utils.plotting",
+    "oct_utils.pipeline",
+    "02_interpolate",
+    "03_visualize",
+    "06_pr_radial_to_8x8_map",
+    "07_pr_desnity_to_weights",
+    "08_score",
+    "run_pipeline",
+]
+
+# run in the child interpreter; numpy is imported first so that its (unavoidable) cost is not counted
+PROBE = """
+import importlib, json, sys, time
+import numpy
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [name for name in sys.argv[2:] if name in sys.modules]}))
+"""
+
+
+def time_import(entry_point: str, repeats: int = 5) -> dict:
+    """ Best-of-repeats import time of the entry point, each time in a new interpreter. """
+    best = None
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, "-c", PROBE, entry_point] + HEAVY_MODULES,
+                                   cwd=REPO_DIR, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise Exception(f"importing {entry_point} failed:\n{completed.stderr}")
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of each entry point, in a fresh interpreter.")
+    parser.add_argument("entry_points", nargs="*", default=ENTRY_POINTS, help="module names (default: all)")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--history", help="jsonl file to append the results to")
+    parser.add_argument("--max-seconds", type=float, help="fail if any import takes longer than this")
+    args = parser.parse_args()
+
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+    too_slow = []
+    records = []
+    for entry_point in args.entry_points:
+        result = time_import(entry_point, args.repeats)
+        loaded = ", ".join(result["loaded"]) if result["loaded"] else "-"
+        print(f"{entry_point:<30} {result['seconds']:7.3f} s   heavy modules loaded: {loaded}")
+        records.append({"time": timestamp, "python": sys.version.split()[0], "entry_point": entry_point, **result})
+        if args.max_seconds is not None and result["seconds"] > args.max_seconds:
+            too_slow.append(entry_point)
+
+    if args.history:
+        with open(args.history, "a") as outf:
+            for record in records:
+                outf.write(json.dumps(record) + "\n")
+    if too_slow:
+        print(f"slower than {args.max_seconds} s: {', '.join(too_slow)}")
+        sys.exit(1)
+
+
+#######################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Confidence intervals for the weighted thickness scores.
+
+Two kinds of replicates of each scan's zone values are generated, thousands at a time:
+    perturbation  - each zone is perturbed by Gaussian noise whose SD grows as its
+                    ValidPixelPercentage drops:  noise_sd * sqrt(100 / valid_pct)  (the default)
+    bootstrap     - the zones are resampled with replacement (Poisson bootstrap);
+                    it does not use the ValidPixelPercentage
+and the score is recomputed for every replicate with the scheme's weights.
+The replicates are drawn in float32, and the chunks are small enough
+(DEFAULT_CHUNK_SIZE scans: ~8 MB of draws per chunk at 2000 replicates) to run in any worker.
+
+The scans are processed in fixed-size chunks, each with its own seed spawned from the
+seed given, so the results are reproducible regardless of the number of worker processes.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from oct_utils.cohort import stack_maps
+from oct_utils.data_structures import PosteriorPoleData
+from oct_utils.stats import WEIGHT_TYPES, scheme_weights, weighted_avg_stack
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+BOOTSTRAP_METHODS = ["perturbation", "bootstrap"]
+DEFAULT_CHUNK_SIZE = 16
+# Spectralis reports whole micrometres; the noise level is a guess at the per-zone measurement error, in mm
+DEFAULT_NOISE_SD = 0.005
+# the valid pixel percentage is floored here, to keep the noise finite for the zones with nothing valid
+MIN_VALID_PCT = 1.0
+
+
+def scheme_weight_matrix(weight_type: str, maps: np.ndarray, valid_pct: np.ndarray,
+                         weight_by_valid_pct: bool = False) -> np.ndarray:
+    """ Flattened (N, 64) weights of the scheme for each map, 0 wherever the map is missing. """
+    weights = scheme_weights(weight_type, valid_pct if weight_by_valid_pct else None)
+    weights = np.broadcast_to(weights, maps.shape).reshape(len(maps), -1)
+    return np.where(np.isnan(maps.reshape(len(maps), -1)), 0.0, weights)
+
+
+def score_replicates(maps: np.ndarray, valid_pct: np.ndarray, weight_types: list[str], n_replicates: int,
+                     method: str = "perturbation", noise_sd: float = DEFAULT_NOISE_SD,
+                     weight_by_valid_pct: bool = False, rng: np.random.Generator | None = None) -> dict:
+    """
+    Scores of n_replicates replicates of each map, for each scheme.
+    The replicates are drawn once and shared by all schemes; each scheme then
+    takes a single batched matrix product.
+
+    Parameters:
+    -----------
+    maps : array
+        Thickness maps (N, 8, 8); NaN where missing
+    valid_pct : array
+        ValidPixelPercentage of each zone (N, 8, 8)
+    weight_types : list[str]
+        Any of WEIGHT_TYPES
+    weight_by_valid_pct : bool
+        Use valid_pct as the weights in the schemes without weights of their own,
+        as weighted_avg does for the original (not interpolated) maps
+
+    Returns:
+    --------
+    dict
+        weight_type -> replicate scores (N, n_replicates)
+    """
+    if rng is None: rng = np.random.default_rng()
+    n_maps = len(maps)
+    values = np.nan_to_num(maps.reshape(n_maps, -1), nan=0.0)
+    n_cells = values.shape[1]
+
+    if method == "bootstrap":
+        # Poisson bootstrap: each zone is drawn Poisson(1) times, independently of the others,
+        # which makes the same draws valid for any subset of zones, i.e. for every scheme
+        counts = rng.poisson(1.0, (n_maps, n_replicates, n_cells)).astype(np.float32)
+    elif method == "perturbation":
+        reliability = np.maximum(np.asarray(valid_pct, dtype=float).reshape(n_maps, -1), MIN_VALID_PCT)
+        noise = rng.standard_normal((n_maps, n_replicates, n_cells), dtype=np.float32)
+        noise *= (noise_sd * np.sqrt(100.0 / reliability)).astype(np.float32)[:, None, :]
+    else:
+        raise Exception(f"Unrecognized resampling method: {method}")
+
+    replicates = {}
+    for weight_type in weight_types:
+        weights = scheme_weight_matrix(weight_type, maps, valid_pct, weight_by_valid_pct)[:, :, None]
+        # the matrix products in float32, like the draws
+        weights_f4 = weights.astype(np.float32)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if method == "bootstrap":
+                # replicates in which no zone of the region was drawn come out as NaN
+                replicates[weight_type] = (np.matmul(counts, (values[:, :, None] * weights).astype(np.float32))
+                                           / np.matmul(counts, weights_f4))[..., 0]
+            else:
+                sum_of_weights = weights.sum(axis=1)
+                estimate = (values[:, :, None] * weights).sum(axis=1) / sum_of_weights
+                replicates[weight_type] = (estimate + np.matmul(noise, weights_f4)[..., 0] / sum_of_weights)
+    return replicates
+
+
+def _chunk_intervals(maps, valid_pct, weight_types, n_replicates, confidence, method, noise_sd,
+                     weight_by_valid_pct, seed_seq) -> dict:
+    """ Worker-side job: estimates and intervals for one chunk of scans, for all schemes. """
+    rng = np.random.default_rng(seed_seq)
+    tail = 100.0 * (1.0 - confidence) / 2.0
+    replicates = score_replicates(maps, valid_pct, weight_types, n_replicates, method, noise_sd,
+                                  weight_by_valid_pct, rng)
+    results = {}
+    for weight_type in weight_types:
+        weights = scheme_weights(weight_type, valid_pct if weight_by_valid_pct else None)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            estimate = weighted_avg_stack(maps, weights)
+        (ci_low, ci_high) = np.nanpercentile(replicates[weight_type], [tail, 100.0 - tail], axis=1)
+        results[weight_type] = (estimate, ci_low, ci_high)
+    return results
+
+
+def confidence_intervals(maps: np.ndarray, valid_pct: np.ndarray, weight_types: list[str] | None = None,
+                         n_replicates: int = 2000, confidence: float = 0.95, method: str = "perturbation",
+                         noise_sd: float = DEFAULT_NOISE_SD, weight_by_valid_pct: bool = False, seed: int = 0,
+                         n_workers: int | None = 1, chunk_size: int = DEFAULT_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Score and its confidence interval for every map and every weighting scheme.
+
+    Returns:
+    --------
+    pd.DataFrame
+        One row per map, with columns  <weight_type>, <weight_type>_ci_low, <weight_type>_ci_high
+        for each scheme; the row order follows the order of the maps.
+        With n_workers other than 1, the chunks of scans are spread over a process pool.
+    """
+    if weight_types is None: weight_types = WEIGHT_TYPES
+    if method not in BOOTSTRAP_METHODS:
+        raise Exception(f"Unrecognized resampling method: {method}")
+    maps = np.asarray(maps, dtype=float)
+    valid_pct = np.asarray(valid_pct, dtype=float)
+
+    starts = list(range(0, len(maps), chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    jobs = [(maps[s:s + chunk_size], valid_pct[s:s + chunk_size], weight_types, n_replicates, confidence,
+             method, noise_sd, weight_by_valid_pct, seed_seq) for s, seed_seq in zip(starts, seeds)]
+
+    if n_workers == 1:
+        chunk_results = [_chunk_intervals(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            chunk_results = list(pool.map(_chunk_intervals, *zip(*jobs))) if jobs else []
+
+    import pandas as pd
+
+    columns = {}
+    for weight_type in weight_types:
+        for i, suffix in enumerate(["", "_ci_low", "_ci_high"]):
+            parts = [chunk[weight_type][i] for chunk in chunk_results]
+            columns[f"{weight_type}{suffix}"] = np.concatenate(parts) if parts else np.array([])
+    return pd.DataFrame(columns)
+
+
+def ppd_confidence_intervals(ppds: list[PosteriorPoleData], interp: bool = True, **kwargs) -> pd.DataFrame:
+    """ confidence_intervals() for a list of scans, with the identifying columns prepended. """
+    maps = stack_maps(ppds, "interpolated_map" if interp else "pp_map")
+    valid_pct = stack_maps(ppds, "weights")
+    intervals = confidence_intervals(maps, valid_pct, weight_by_valid_pct=not interp, **kwargs)
+    import pandas as pd
+    ids = pd.DataFrame({
+        "alias": [ppd.alias for ppd in ppds],
+        "eye": [ppd.laterality for ppd in ppds],
+        "age_acquired": [ppd.age_at_test for ppd in ppds],
+        "file_md5": [ppd.filename_md5 for ppd in ppds],
+    })
+    return pd.concat([ids, intervals], axis=1)
@@ -1,24 +1,55 @@
+from __future__ import annotations
+
 from statistics import mean
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from oct_utils.identity import IdentityIndex
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 CHOROID_THICKNESS_CUTOFF = 440
 
-def choroid_thckness(chorthck_df, alias, age, eye) -> float:
 
-    alias = alias.replace("_", " ")
-    cond1 = chorthck_df['Patient']==alias
-    cond2 = abs(chorthck_df['Age at Visit'] - age) < 0.5
+class ChoroidIndex:
+    """
+    The choroid thickness table, grouped by patient id once, so that each lookup
+    touches only the measurements of one patient.
+    """
+    def __init__(self, chorthck_df: pd.DataFrame, identity: IdentityIndex):
+        self.identity = identity
+        patient_ids = identity.ids_of(chorthck_df['Patient'])
+        ages = chorthck_df['Age at Visit'].to_numpy(dtype=float)
+        thicknesses = chorthck_df['JP Measurements (μm)'].to_numpy(dtype=float)
+        order = np.argsort(patient_ids, kind="stable")
+        (unique_ids, starts) = np.unique(patient_ids[order], return_index=True)
+        self.measurements: dict[int, tuple[np.ndarray, np.ndarray]] = {
+            int(patient_id): (patient_ages, patient_thicknesses)
+            for patient_id, patient_ages, patient_thicknesses
+            in zip(unique_ids, np.split(ages[order], starts[1:]), np.split(thicknesses[order], starts[1:]))
+        }
+
+    def lookup(self, patient_id: int, age: float) -> np.ndarray:
+        """ The thickness values measured within half a year of the age. """
+        if patient_id not in self.measurements: return np.array([])
+        (ages, thicknesses) = self.measurements[patient_id]
+        return thicknesses[np.abs(ages - age) < 0.5]
+
+
+def choroid_thckness(chorthck_index: ChoroidIndex, patient_id: int, age, eye) -> float:
+
     # cond3 = chorthck_df['Eye']==eye
-    conditions = cond1 & cond2
-    filtered_df = chorthck_df[conditions]
+    values = chorthck_index.lookup(patient_id, age)
 
-    number_of_rows = len(filtered_df)
+    number_of_rows = len(values)
     if number_of_rows > 2:
-        print(f"multiple thickness values found for {alias}  {eye}  {age}")
-        exit()
+        raise ValueError(f"multiple thickness values found for {chorthck_index.identity.alias(patient_id)}  {eye}  {age}")
     if number_of_rows == 1:
-        thickness = filtered_df['JP Measurements (μm)'].iloc[0]
+        thickness = float(values[0])
     elif number_of_rows == 2:  # I am assuming this is the left and the right eye
-        thickness = mean(filtered_df['JP Measurements (μm)'].iloc[i] for i in range(2))
+        thickness = mean(float(values[i]) for i in range(2))
     else:
         # print(f"no thickness found for {alias} {age}, either eye")
         thickness =  -1.0
@@ -26,10 +57,10 @@ def choroid_thckness(chorthck_df, alias, age, eye) -> float:
     return thickness
 
 
-def choroid_thickness_normal(chorthck_df, alias, age, eye) -> bool:
+def choroid_thickness_normal(chorthck_index: ChoroidIndex, patient_id: int, age, eye) -> bool:
     # the cutoff value of 440 is based on https://iovs.arvojournals.org/article.aspx?articleid=2127819
     # where they measure normal thickness in children age 10015 to be 359 ± 77 μm
-    thickness =  choroid_thckness(chorthck_df, alias, age, eye)
+    thickness =  choroid_thckness(chorthck_index, patient_id, age, eye)
 
     if thickness < CHOROID_THICKNESS_CUTOFF:
         return True
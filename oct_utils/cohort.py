@@ -0,0 +1,27 @@
+"""
+Stacking of per-scan maps into cohort-wide arrays, for the vectorized computations.
+"""
+import numpy as np
+
+from oct_utils.data_structures import PosteriorPoleData
+
+
+def stack_maps(ppds: list[PosteriorPoleData], map_name: str = "interpolated_map") -> np.ndarray:
+    """
+    (N, 8, 8) float array of the chosen map (pp_map, weights or interpolated_map); NaN where missing.
+    The compact maps are decoded straight into the stack.
+    """
+    stack = np.full((len(ppds), 8, 8), np.nan)
+    for i, ppd in enumerate(ppds):
+        thck_map = ppd.map_array(map_name)
+        if thck_map is not None: stack[i] = thck_map
+    return stack
+
+
+def stack_ages(ppds: list[PosteriorPoleData]) -> np.ndarray:
+    return np.array([ppd.age_at_test for ppd in ppds], dtype=float)
+
+
+def series_labels(ppds: list[PosteriorPoleData]) -> list[tuple[int, str]]:
+    """ The (patient_id, eye) series each scan belongs to. """
+    return [(ppd.patient_id, ppd.laterality) for ppd in ppds]
@@ -0,0 +1,98 @@
+"""
+Compact encodings of the 8x8 maps, for holding and storing large cohorts.
+
+    f8    float64, as parsed (512 bytes per 8x8 map)
+    f4    float32 (256 bytes); ~7 significant digits
+    i2    int16 in fixed units (128 bytes): whole micrometres for the thickness maps,
+          hundredths of a percent for the valid pixel percentages; NaN is stored
+          as the I2_NAN sentinel
+    auto  i2 where that is exact (the maps as exported by Spectralis, which reports
+          whole micrometres), f4 otherwise (e.g. the interpolated maps)
+
+The encoded arrays are little-endian, so their bytes can go to disk as they are;
+the codec of a blob is told apart by its length.
+"""
+import numpy as np
+
+MAP_CODECS = ["f8", "f4", "i2", "auto"]
+CODEC_DTYPES = {"f8": np.dtype("<f8"), "f4": np.dtype("<f4"), "i2": np.dtype("<i2")}
+I2_NAN = np.iinfo(np.int16).min
+# i2 units per unit of the map: the thicknesses are in mm, the valid pixel percentages in percent
+MAP_SCALES = {"pp_map": 1000.0, "interpolated_map": 1000.0, "weights": 100.0}
+DEFAULT_SCALE = 1000.0
+
+
+def i2_exact(values: np.ndarray, scale: float = DEFAULT_SCALE) -> bool:
+    """ True if every value is a whole number of i2 units, within the int16 range. """
+    values = np.asarray(values, dtype=float)
+    scaled = values[~np.isnan(values)] * scale
+    rounded = np.round(scaled)
+    return bool(np.all(np.abs(scaled - rounded) < 1e-6) and np.all(np.abs(rounded) < -I2_NAN))
+
+
+def encode(values: np.ndarray, codec: str = "f8", scale: float = DEFAULT_SCALE) -> np.ndarray:
+    """ The values (float, NaN where missing) in the codec's dtype. """
+    values = np.asarray(values, dtype=float)
+    if codec == "auto": codec = "i2" if i2_exact(values, scale) else "f4"
+    if codec not in CODEC_DTYPES:
+        raise ValueError(f"Unrecognized map codec: {codec}")
+    if codec != "i2":
+        return values.astype(CODEC_DTYPES[codec])
+    missing = np.isnan(values)
+    scaled = np.round(np.where(missing, 0.0, values) * scale)
+    if np.any(np.abs(scaled) >= -I2_NAN):
+        raise ValueError(f"Value out of the int16 range at scale {scale}")
+    return np.where(missing, I2_NAN, scaled).astype(CODEC_DTYPES["i2"])
+
+
+def decode(encoded: np.ndarray, scale: float = DEFAULT_SCALE) -> np.ndarray:
+    """ float64 values of an encoded array (a new array, never a view of the encoded one). """
+    if encoded.dtype.kind == "i":
+        return np.where(encoded == I2_NAN, np.nan, encoded / scale)
+    return encoded.astype(float)
+
+
+class CompactMap:
+    """
+    A map held in its encoded form. It can be assigned to the map attributes of
+    PosteriorPoleData: being callable, it serves as their loader, and the DataFrame
+    is only built if the attribute is read; PosteriorPoleData.map_array() decodes
+    it straight to a numpy array instead.
+    """
+    __slots__ = ("encoded", "scale")
+
+    def __init__(self, encoded: np.ndarray, scale: float = DEFAULT_SCALE):
+        self.encoded = encoded
+        self.scale = scale
+
+    @classmethod
+    def from_values(cls, values, codec: str = "auto", scale: float = DEFAULT_SCALE) -> "CompactMap":
+        return cls(encode(values, codec, scale), scale)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes, shape: tuple[int, ...] = (8, 8), scale: float = DEFAULT_SCALE) -> "CompactMap":
+        """ Zero-copy view of a blob written by to_bytes(); the codec follows from its length. """
+        n_values = int(np.prod(shape))
+        itemsize = len(blob) // n_values if n_values else 0
+        dtypes = {dtype.itemsize: dtype for dtype in CODEC_DTYPES.values()}
+        if itemsize not in dtypes or itemsize * n_values != len(blob):
+            raise ValueError(f"A blob of {len(blob)} bytes is not an encoded {'x'.join(map(str, shape))} map")
+        return cls(np.frombuffer(blob, dtype=dtypes[itemsize]).reshape(shape), scale)
+
+    @property
+    def codec(self) -> str:
+        return {dtype: codec for codec, dtype in CODEC_DTYPES.items()}[self.encoded.dtype]
+
+    @property
+    def nbytes(self) -> int:
+        return self.encoded.nbytes
+
+    def to_array(self) -> np.ndarray:
+        return decode(self.encoded, self.scale)
+
+    def to_bytes(self) -> bytes:
+        return self.encoded.tobytes()
+
+    def __call__(self):
+        import pandas as pd
+        return pd.DataFrame(self.to_array())
@@ -1,4 +1,24 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def normalize_alias(alias: str) -> str:
+    """
+    The canonical form of an alias: words separated by single spaces (directory names use underscores),
+    and the number of a control zero-padded to two digits ("Control 1" -> "Control 01").
+    Cached, so each distinct string is worked on only once.
+    """
+    tokens = alias.replace("_", " ").split()
+    if tokens and "control" in alias.lower():
+        tokens = tokens[:-1] + [tokens[-1].zfill(2)]
+    return " ".join(tokens)
+
+
+@lru_cache(maxsize=None)
+def alias_dir_name(alias: str) -> str:
+    """ Name of the directory holding the xml files of the (canonical) alias. """
+    return normalize_alias(alias).replace(" ", "_")
+
 
 def controls_alias_hack(ppd):
-     tokens = ppd.alias.split()
-     ppd.alias = " ".join(tokens[:-1] + [tokens[-1].zfill(2)])
+    ppd.alias = normalize_alias(ppd.alias)
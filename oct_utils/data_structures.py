@@ -1,35 +1,104 @@
+from __future__ import annotations
+
 import hashlib
+from functools import partial
 from io import StringIO
+from typing import TYPE_CHECKING
 
 import numpy as np
-import pandas as pd
 
-from oct_utils.conventions import controls_alias_hack
+from oct_utils.compact_maps import MAP_SCALES, CompactMap
+from oct_utils.conventions import alias_dir_name, normalize_alias
+from oct_utils.thickness_grids import ThicknessGrid
+
+# pandas is imported where it is first needed: modules that only handle the stacked
+# numpy arrays (e.g. the normative reference) can import this one without it
+if TYPE_CHECKING:
+    import pandas as pd
 
 POSTERIOR_POLE_TABLE_NAME = "posterior_pole_data"
 
+
+class LazyMap:
+    """
+    Map attribute that is decoded only on first access. It can be assigned either
+    a DataFrame (or None), or a loader - a callable without arguments, returning the DataFrame.
+    The loader is called the first time the attribute is read, and its result replaces it.
+    """
+    def __set_name__(self, owner, name):
+        self.private_name = f"_{name}"
+
+    def __get__(self, instance, owner=None):
+        if instance is None: return None
+        value = instance.__dict__.get(self.private_name)
+        if callable(value):
+            value = value()
+            instance.__dict__[self.private_name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.private_name] = value
+
+
+def full_map(fill_value: float) -> pd.DataFrame:
+    import pandas as pd
+    return pd.DataFrame(np.full((8, 8), fill_value, dtype=float))
+
+
+def map_from_json(map_json: str) -> pd.DataFrame:
+    import pandas as pd
+    return pd.read_json(StringIO(map_json))
+
+
+def file_md5(path: str) -> str:
+    with open(path, 'rb') as inf:
+        return hashlib.md5(inf.read()).hexdigest()
+
+
 class PosteriorPoleData:
     table_name: str = POSTERIOR_POLE_TABLE_NAME
     alias: str = ""
+    patient_id: int | None = None
     laterality:  str = ""
     age_at_test: float = -1
     total_volume: float = -1
-    pp_map: pd.DataFrame  | None = None
-    weights: pd.DataFrame | None = None
-    interpolated_map: pd.DataFrame | None = None
+    pp_map: pd.DataFrame  | None = LazyMap()
+    weights: pd.DataFrame | None = LazyMap()
+    interpolated_map: pd.DataFrame | None = LazyMap()
     choroid_ok: bool = True
     filename: str | None = None
     filename_md5: str | None = None
     avg_thickness: float | None = None
     wtd_avg_thickness: float | None = None
+    thickness_grids: dict[str, ThicknessGrid]  # grid name -> grid, as parsed; not loaded by the result store queries
 
     def __init__(self, alias="", laterality="", age_at_test=-1):
         self.alias = alias
         self.laterality = laterality
         self.age_at_test = age_at_test
-        self.pp_map  = pd.DataFrame(np.full((8, 8), np.nan))
-        self.weights = pd.DataFrame(np.full((8, 8), 100.0, dtype=float))
-
+        self.pp_map  = partial(full_map, np.nan)
+        self.weights = partial(full_map, 100.0)
+        self.interpolated_map = None
+        self.thickness_grids = {}
+
+    def is_loaded(self, map_name: str) -> bool:
+        """ False if the map (pp_map, weights or interpolated_map) is still waiting to be decoded. """
+        return not callable(self.__dict__.get(f"_{map_name}"))
+
+    def map_array(self, map_name: str) -> np.ndarray | None:
+        """ The map as a float array (NaN where missing); a compact map is decoded without building the DataFrame. """
+        value = self.__dict__.get(f"_{map_name}")
+        if isinstance(value, CompactMap): return value.to_array()
+        value = getattr(self, map_name)
+        return None if value is None else np.asarray(value, dtype=float)
+
+    def compact(self, codec: str = "auto"):
+        """ Replace the maps by their compact encoding (see oct_utils.compact_maps) to save memory. """
+        for map_name in ["pp_map", "weights", "interpolated_map"]:
+            values = self.map_array(map_name)
+            if values is None: continue
+            setattr(self, map_name, CompactMap.from_values(values, codec, MAP_SCALES[map_name]))
+        return self
 
     def __str__(self):
         retstr = f"alias: {self.alias}\n"
@@ -61,10 +130,13 @@ class PosteriorPoleData:
         pp_map_json = self.pp_map.to_json() if self.pp_map is not None else None
         interpolated_map_json = self.interpolated_map.to_json() if self.interpolated_map is not None else None
 
-        fnm = self.filename
-        # 'calculated'  because it can be checked against the value stored in db or some such
-        # (not implemented here yet)
-        calculated_md5 = hashlib.md5(open(f"{xml_dir_path}/{fnm}",'rb').read()).hexdigest()
+        if self.filename_md5 is not None:
+            # the md5 was computed from the same bytes that were parsed - no need to read the file again
+            calculated_md5 = self.filename_md5
+        else:
+            # 'calculated'  because it can be checked against the value stored in db or some such
+            # (not implemented here yet)
+            calculated_md5 = file_md5(f"{xml_dir_path}/{self.filename}")
 
         update_fields = {'alias': self.alias,
                          'eye': self.laterality,
@@ -104,18 +176,23 @@ class PosteriorPoleData:
 
         oct_df.loc[len(oct_df)] = new_row  # Append row in place using loc
 
-    def pd_dataframe_read(self, oct_df: pd.DataFrame, index: int, fussy: bool = True, xml_dir_path: str | None = None):
+    def pd_dataframe_read(self, oct_df: pd.DataFrame, index: int, fussy: bool = True, xml_dir_path: str | None = None,
+                          md5_check=None):
         """
         Reads data from a pandas dataframe row and populates the current instance's attributes.
+        The maps are decoded only when first accessed. If md5_check (a DeferredMd5Check) is given,
+        the fussy md5 verification is queued there instead of blocking the read.
         """
         if index not in oct_df.index:
             raise ValueError(f"Index {index} not found in dataframe")
 
+        import pandas as pd
+
         row = oct_df.loc[index]
 
         # Populate basic attributes
-        self.alias = row['alias']
-        if "control" in self.alias.lower(): controls_alias_hack(self)
+        self.alias = normalize_alias(row['alias'])
+        if 'patient_id' in row.index: self.patient_id = row['patient_id']
         self.laterality = row['eye']
         self.age_at_test = row['age_acquired']
         self.filename = row['file_name']
@@ -123,16 +200,27 @@ class PosteriorPoleData:
         self.total_volume = row['total_volume']
         self.choroid_ok = row['choroid_ok']
 
-        # Deserialize DataFrames from JSON strings
-        self.pp_map = pd.read_json(StringIO(row['pp_map'])) if pd.notna(row['pp_map']) else None
-        self.interpolated_map = pd.read_json(StringIO(row['interpolated_map'])) if pd.notna(row['interpolated_map']) else None
+        # Deserialize DataFrames from JSON strings, on first access
+        self.pp_map = partial(map_from_json, row['pp_map']) if pd.notna(row['pp_map']) else None
+        self.interpolated_map = partial(map_from_json, row['interpolated_map']) if pd.notna(row['interpolated_map']) else None
 
         # MD5 verification in fussy mode
         if fussy:
-            if self.filename is None or self.filename_md5 is None or xml_dir_path is None:
-                raise ValueError("Fussy mode requires filename, filename_md5, and xml_dir_path")
-            dir_path = f"{xml_dir_path}/{self.alias.replace(" ", "_")}/{self.laterality}"
-            calculated_md5 = hashlib.md5(open(f"{dir_path}/{self.filename}", 'rb').read()).hexdigest()
+            if md5_check is None:
+                self.verify_md5(xml_dir_path)
+            else:
+                md5_check.submit(self, xml_dir_path)
+
+    def source_path(self, xml_dir_path: str | None) -> str:
+        if self.filename is None or self.filename_md5 is None or xml_dir_path is None:
+            raise ValueError("Fussy mode requires filename, filename_md5, and xml_dir_path")
+        return f"{xml_dir_path}/{alias_dir_name(self.alias)}/{self.laterality}/{self.filename}"
+
+    def verify_md5(self, xml_dir_path: str | None):
+        """
+        Checks the md5 of the source xml file against the stored one. Raises ValueError on mismatch.
+        """
+        calculated_md5 = file_md5(self.source_path(xml_dir_path))
 
-            if calculated_md5 != self.filename_md5:
-                raise ValueError(f"MD5 mismatch for {self.filename}: expected {self.filename_md5}, got {calculated_md5}")
+        if calculated_md5 != self.filename_md5:
+            raise ValueError(f"MD5 mismatch for {self.filename}: expected {self.filename_md5}, got {calculated_md5}")
@@ -0,0 +1,74 @@
+"""
+Integer patient ids, assigned once per cohort to the canonical form of each alias.
+
+The stages group and join on the ids, so the string normalization
+happens once per distinct alias rather than once per row or lookup.
+"""
+from __future__ import annotations
+
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from oct_utils.conventions import normalize_alias
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class IdentityIndex:
+    """
+    Usage:
+        identity = IdentityIndex()
+        patient_id = identity.id_of("Control_1")        # same id as for "Control 01"
+        df["patient_id"] = identity.ids_of(df["alias"])
+        identity.alias(patient_id)                      # "Control 01"
+    """
+
+    def __init__(self, entries: Iterable[tuple[int, str]] = ()):
+        """ entries: (patient_id, canonical alias) pairs, e.g. as stored in the result store """
+        self.aliases: dict[int, str] = {}
+        self.ids: dict[str, int] = {}
+        for patient_id, alias in entries:
+            self.aliases[patient_id] = alias
+            self.ids[alias] = patient_id
+        self.next_id = max(self.aliases, default=0) + 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def items(self) -> list[tuple[int, str]]:
+        return sorted(self.aliases.items())
+
+    def get(self, alias: str) -> int | None:
+        """ The id of the alias, or None if it is not in the index. """
+        return self.ids.get(normalize_alias(alias))
+
+    def id_of(self, alias: str) -> int:
+        """ The id of the alias; aliases not seen before get the next free id. """
+        canonical = normalize_alias(alias)
+        patient_id = self.ids.get(canonical)
+        if patient_id is None:
+            patient_id = self.next_id
+            self.next_id += 1
+            self.ids[canonical] = patient_id
+            self.aliases[patient_id] = canonical
+        return patient_id
+
+    def ids_of(self, aliases: pd.Series | Iterable[str]) -> np.ndarray:
+        """
+        Vectorized id_of: each distinct alias in the column is normalized only once.
+        Raises ValueError if any alias is missing.
+        """
+        import pandas as pd
+
+        # missing aliases get code -1, which would otherwise index the last of the unique ids
+        codes, uniques = pd.factorize(pd.Series(aliases, dtype=object), use_na_sentinel=True)
+        if np.any(codes < 0):
+            raise ValueError(f"Missing alias at position(s) {np.flatnonzero(codes < 0).tolist()}")
+        unique_ids = np.array([self.id_of(alias) for alias in uniques], dtype=np.int64)
+        return unique_ids[codes]
+
+    def alias(self, patient_id: int) -> str:
+        return self.aliases[patient_id]
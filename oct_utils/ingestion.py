@@ -0,0 +1,315 @@
+"""
+Asynchronous ingestion of the xml exports.
+
+The files are read by a few async readers into a bounded queue (the read-ahead),
+parsed in a pool of worker processes, and each alias/eye series is handed over
+to interpolation as soon as all of its files have been parsed. The bounded queue,
+the fixed number of parser tasks and the limited number of series waiting for (or in)
+interpolation provide the backpressure: at any time there are at most
+read_ahead + n_readers + n_workers  files held in memory, and the parsed scans of at most
+max_pending_series  series handed over to interpolation (plus those of the series still
+being parsed), no matter how large the archive is. When interpolation falls behind,
+the parsers wait for it, and the readers for the parsers.
+
+A file that cannot be read or parsed, or a worker process that dies, costs only
+its own series, which can be handed over to a checkpoint as soon as it is done.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING
+
+from oct_utils.choroid import ChoroidIndex, choroid_thickness_normal
+from oct_utils.data_structures import PosteriorPoleData
+from oct_utils.identity import IdentityIndex
+from oct_utils.interpolation import interpolate_3d
+from oct_utils.interpolation_cache import InterpolationCache
+from oct_utils.quality_control import QualityGate
+from oct_utils.xml_parsing import extract_pp_map_from_bytes
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+EYES = ["OD", "OS"]
+
+
+def list_xml_series(homedir: str) -> dict[tuple[str, str], list[str]]:
+    """ Map each (alias, eye) found in  homedir/alias/eye  to the list of its xml files. """
+    series = {}
+    for alias in sorted(os.listdir(homedir)):
+        for eye in EYES:
+            eyedir = f"{homedir}/{alias}/{eye}"
+            if not os.path.isdir(eyedir): continue
+            xmlfiles = sorted(f for f in os.listdir(eyedir) if f[-4:] == ".xml")
+            if xmlfiles: series[(alias, eye)] = [f"{eyedir}/{f}" for f in xmlfiles]
+    return series
+
+
+def parse_xml_bytes(xml_bytes: bytes, xmlpath: str, codec: str | None = None) -> PosteriorPoleData | None:
+    """ Worker-side job: hash and parse the content of a single file, read only once. """
+    ppd = extract_pp_map_from_bytes(xml_bytes, xmlpath)
+    if ppd is None: return None
+    ppd.filename = os.path.basename(xmlpath)
+    ppd.filename_md5 = hashlib.md5(xml_bytes).hexdigest()
+    if codec is not None: ppd.compact(codec)
+    return ppd
+
+
+def interpolate_series(ppds: list[PosteriorPoleData], codec: str | None = None,
+                       cache_dir: str | None = None) -> list[PosteriorPoleData]:
+    """ Worker-side job: interpolate one alias/eye series and send it back. """
+    sorted_ppds = sorted(ppds, key=lambda ppd: ppd.age_at_test)
+    interpolate_3d(sorted_ppds, None if cache_dir is None else InterpolationCache(cache_dir))
+    if codec is not None:
+        for ppd in sorted_ppds: ppd.compact(codec)
+    return sorted_ppds
+
+
+def series_fingerprint(paths: list[str]) -> str:
+    """ Hash of the names, sizes and modification times of the files of a series (the files are not read). """
+    entries = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        entries.append(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as inf:
+        return inf.read()
+
+
+# worker side: where each job reports that it has started (see _WorkerPool)
+_started_queue = None
+
+
+def _init_worker(started_queue):
+    global _started_queue
+    _started_queue = started_queue
+
+
+def _tracked_job(job_id: int, func, *args):
+    # SimpleQueue.put writes to the pipe right away, so the report survives a crash of the job
+    _started_queue.put(job_id)
+    return func(*args)
+
+
+class _WorkerPool:
+    """
+    Process pool that survives the death of a worker (e.g. a segfault in a C extension). The broken pool
+    is replaced. The jobs that were still queued in it go to the replacement pool. Each job that was running
+    is tried again in a process of its own, one job at a time, so that the job that kills its worker again
+    fails alone, without taking the other jobs down with it (and without a process for each of them).
+    """
+
+    def __init__(self, max_workers: int | None):
+        self.max_workers = max_workers
+        self.job_ids = itertools.count()
+        self.started = set()  # the jobs reported as started and not finished
+        self.isolation = asyncio.Semaphore(1)
+        self.pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        self.started_queue = multiprocessing.SimpleQueue()
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                   initargs=(self.started_queue,))
+
+    def _collect_started(self):
+        while not self.started_queue.empty():
+            self.started.add(self.started_queue.get())
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        job_id = next(self.job_ids)
+        while True:
+            pool = self.pool
+            try:
+                return await loop.run_in_executor(pool, _tracked_job, job_id, func, *args)
+            except BrokenProcessPool:
+                if self.pool is pool:
+                    print("Warning: a worker process died, restarting the pool")
+                    self._collect_started()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = self._new_pool()
+                if job_id in self.started: break
+                # still queued when the pool broke: try again in the replacement pool
+            finally:
+                if self.pool is pool: self._collect_started()
+                self.started.discard(job_id)
+        async with self.isolation:
+            isolated = ProcessPoolExecutor(max_workers=1)
+            try:
+                return await loop.run_in_executor(isolated, func, *args)
+            except BrokenProcessPool:
+                raise BrokenProcessPool(f"{func.__name__} kills the worker process running it") from None
+            finally:
+                isolated.shutdown(wait=False)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+async def _reader(paths: asyncio.Queue, read_queue: asyncio.Queue):
+    while True:
+        item = await paths.get()
+        if item is None: break
+        series_key, path = item
+        try:
+            xml_bytes = await asyncio.to_thread(_read_bytes, path)
+        except OSError as e:
+            print(f"Warning: could not read {path}: {e}")
+            xml_bytes = None
+        # blocks when the read-ahead is full - this is where the backpressure kicks in
+        await read_queue.put((series_key, path, xml_bytes))
+
+
+async def _parser(read_queue: asyncio.Queue, pool: _WorkerPool, on_parsed, codec: str | None):
+    while True:
+        item = await read_queue.get()
+        if item is None: break
+        series_key, path, xml_bytes = item
+        ppd = None
+        failed = xml_bytes is None
+        if xml_bytes is not None:
+            try:
+                ppd = await pool.run(parse_xml_bytes, xml_bytes, path, codec)
+            except Exception as e:
+                print(f"Warning: parsing {path} failed: {e!r}")
+                failed = True
+        del xml_bytes
+        await on_parsed(series_key, ppd, failed)
+
+
+async def _ingest(homedir: str, chorthck_df: pd.DataFrame | None,
+                  read_ahead: int, n_readers: int, n_workers: int | None, codec: str | None,
+                  cache_dir: str | None, quality_gate: QualityGate | None,
+                  skip_series: set | None, on_series, max_pending_series: int | None) -> dict:
+
+    series = {key: paths for key, paths in list_xml_series(homedir).items() if key not in (skip_series or ())}
+    remaining = {key: len(paths) for key, paths in series.items()}
+    parsed = {key: [] for key in series}
+    complete = {key: True for key in series}  # False once any file of the series fails
+    series_tasks = []
+    interpolated_ppds = {}
+    identity = IdentityIndex()
+    chorthck_index = None if chorthck_df is None else ChoroidIndex(chorthck_df, identity)
+
+    paths = asyncio.Queue()
+    for series_key, series_paths in series.items():
+        for path in series_paths:
+            paths.put_nowait((series_key, path))
+    for _ in range(n_readers):
+        paths.put_nowait(None)
+    read_queue = asyncio.Queue(maxsize=read_ahead)
+    parser_count = n_workers or os.cpu_count() or 1
+    # the series handed over to interpolation and not finished yet
+    pending_series = asyncio.Semaphore(max_pending_series or 2 * parser_count)
+
+    pool = _WorkerPool(n_workers)
+    try:
+
+        async def finish_series(series_key, series_ppds):
+            try:
+                if series_ppds:
+                    try:
+                        series_ppds = await pool.run(interpolate_series, series_ppds, codec, cache_dir)
+                    except Exception as e:
+                        # the series is left out, to be redone by the next (resumed) run
+                        print(f"Warning: interpolation of {series_key[0]} {series_key[1]} failed: {e!r}")
+                        return
+                if on_series is not None:
+                    on_series(series_key, series_ppds, complete.pop(series_key))
+                elif series_ppds:
+                    (alias, eye) = series_key
+                    interpolated_ppds.setdefault(alias, {})[eye] = series_ppds
+            finally:
+                pending_series.release()
+
+        async def on_parsed(series_key, ppd, failed):
+            if ppd is not None:
+                (alias, eye) = series_key
+                ppd.patient_id = identity.id_of(alias)
+                try:
+                    ppd.choroid_ok = chorthck_index is None or choroid_thickness_normal(chorthck_index, ppd.patient_id,
+                                                                                        ppd.age_at_test, eye)
+                    parsed[series_key].append(ppd)
+                except ValueError as e:
+                    print(f"Warning: {ppd.filename} left out: {e}")
+                    failed = True
+            if failed: complete[series_key] = False
+            remaining[series_key] -= 1
+            if remaining[series_key] == 0:
+                # the series is complete - the scans failing QC are dropped before any more work is spent on them
+                series_ppds = parsed.pop(series_key)
+                if quality_gate is not None: series_ppds = quality_gate.filter(series_ppds)
+                # interpolation overlaps with the reading of the next series, up to max_pending_series
+                # of them: beyond that, this parser (and with it the read-ahead) waits
+                await pending_series.acquire()
+                series_tasks.append(asyncio.create_task(finish_series(series_key, series_ppds)))
+                series_tasks[:] = [task for task in series_tasks if not task.done()]
+        readers = [asyncio.create_task(_reader(paths, read_queue)) for _ in range(n_readers)]
+        parsers = [asyncio.create_task(_parser(read_queue, pool, on_parsed, codec)) for _ in range(parser_count)]
+        await asyncio.gather(*readers)
+        for _ in parsers:
+            await read_queue.put(None)
+        await asyncio.gather(*parsers)
+        await asyncio.gather(*series_tasks)
+    finally:
+        pool.shutdown()
+
+    return interpolated_ppds
+
+
+def ingest_xml_dir(homedir: str, chorthck_df: pd.DataFrame | None = None, read_ahead: int = 16,
+                   n_readers: int = 4, n_workers: int | None = None, codec: str | None = None,
+                   cache_dir: str | None = None, quality_gate: QualityGate | None = None,
+                   skip_series: set | None = None, on_series=None, max_pending_series: int | None = None) -> dict:
+    """
+    Parse and interpolate all xml files in  homedir/alias/eye.
+
+    Parameters:
+    -----------
+    homedir : str
+        Directory with one subdirectory per alias, each with OD and/or OS subdirectories
+    chorthck_df : pd.DataFrame or None
+        Choroid thickness table; if given, used to set the choroid_ok flag
+    read_ahead : int
+        Maximum number of files read, but not yet parsed
+    n_readers : int
+        Number of concurrent file reads
+    n_workers : int or None
+        Number of parser processes (defaults to the number of CPUs)
+    codec : str or None
+        If given, the maps travel back from the workers, and are returned, in this
+        compact encoding (see oct_utils.compact_maps)
+    cache_dir : str or None
+        If given, the interpolated series are cached there (see oct_utils.interpolation_cache)
+        and the unchanged series are taken from the cache
+    quality_gate : QualityGate or None
+        If given, each series is checked as soon as it is parsed, and the scans
+        failing QC are neither interpolated nor returned (they are kept in quality_gate.rejected);
+        they run on the stacked maps of the series, after the parse (md5, compact maps) of its files
+    skip_series : set or None
+        (alias, eye) series not to read at all, e.g. the ones stored by an earlier run
+    on_series : callable or None
+        Called as  on_series((alias, eye), ppds, complete)  as soon as each series is interpolated,
+        e.g. to checkpoint it; complete is False if any of its files could not be read or parsed.
+        The series handed over are not kept in memory. A series whose interpolation failed
+        is reported and left out.
+    max_pending_series : int or None
+        Maximum number of parsed series handed over to interpolation and not finished yet;
+        the parsing waits for interpolation beyond that (defaults to twice the number of parser processes)
+
+    Returns:
+    --------
+    dict
+        alias -> eye -> list of interpolated PosteriorPoleData (empty if on_series is given)
+    """
+    return asyncio.run(_ingest(homedir, chorthck_df, read_ahead, n_readers, n_workers, codec, cache_dir,
+                               quality_gate, skip_series, on_series, max_pending_series))
@@ -1,14 +1,33 @@
 from itertools import product
 
 import numpy as np
-import pandas as pd
-from scipy.interpolate import LinearNDInterpolator
 
+from oct_utils.cohort import stack_maps
 from oct_utils.data_structures import PosteriorPoleData
+from oct_utils.interpolation_cache import InterpolationCache
 
 
-def interpolate_3d(ppds: list[PosteriorPoleData]):
-    """ Function to perform 3D interpolation on a series of DataFrames """
+def interpolate_3d(ppds: list[PosteriorPoleData], cache: InterpolationCache | None = None):
+    """
+    Function to perform 3D interpolation on a series of DataFrames.
+    With a cache, a series interpolated before (same files, same ages) is filled in from it.
+    """
+    if cache is None or len(ppds) < 2:
+        _interpolate_3d(ppds)
+        return
+
+    filled = cache.get(ppds)
+    if filled is None:
+        _interpolate_3d(ppds)
+        cache.put(ppds, stack_maps(ppds, "interpolated_map"))
+        return
+
+    import pandas as pd
+    for ppd, filled_map in zip(ppds, filled):
+        ppd.interpolated_map = pd.DataFrame(filled_map)
+
+
+def _interpolate_3d(ppds: list[PosteriorPoleData]):
 
     # defend ourselves from useless input:
     if len(ppds) == 0:
@@ -38,6 +57,9 @@ def interpolate_3d(ppds: list[PosteriorPoleData]):
         return
 
     # Use the valid points and their corresponding values to create the interpolator.
+    # (scipy is imported here, rather than at the top, to keep it out of the processes that never interpolate)
+    import pandas as pd
+    from scipy.interpolate import LinearNDInterpolator
     try:
         interpolator = LinearNDInterpolator(valid_points, valid_values)
     except Exception as e:
@@ -0,0 +1,70 @@
+"""
+On-disk cache of the interpolated maps of whole alias/eye series.
+
+interpolate_3d is deterministic given the ordered (file, age) pairs of a series, so its
+result is stored under a hash of those pairs and of the interpolation parameters; the
+series whose files did not change are then not interpolated again, in any later run
+or stage. Each entry is a single .npy file with the filled maps (N, 8, 8), written
+atomically, so concurrent workers can share the cache directory.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from oct_utils.data_structures import PosteriorPoleData
+
+# bump when interpolate_3d changes in a way that changes its results
+INTERPOLATION_VERSION = 1
+INTERPOLATION_PARAMETERS = {"method": "LinearNDInterpolator", "axes": ["age", "row", "col"], "fill": "nan_only"}
+
+
+class InterpolationCache:
+    """
+    Usage:
+        cache = InterpolationCache(f"{scratch_dir}/interpolation_cache")
+        interpolate_3d(ppds, cache=cache)   # a cached series is filled in from the cache
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def series_key(ppds: list[PosteriorPoleData]) -> str | None:
+        """ Hash of the ordered (file_md5, age) pairs and of the parameters; None if any file_md5 is unknown. """
+        if any(ppd.filename_md5 is None for ppd in ppds): return None
+        description = {
+            "version": INTERPOLATION_VERSION,
+            "parameters": INTERPOLATION_PARAMETERS,
+            "series": [[ppd.filename_md5, float(ppd.age_at_test)] for ppd in ppds],
+        }
+        return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key}.npy"
+
+    def get(self, ppds: list[PosteriorPoleData]) -> np.ndarray | None:
+        """ The cached filled maps (N, 8, 8) of the series, or None. """
+        key = self.series_key(ppds)
+        if key is None: return None
+        try:
+            filled = np.load(self._path(key))
+        except (OSError, ValueError):
+            return None
+        if filled.shape != (len(ppds), 8, 8):
+            print(f"Warning: ignoring a malformed interpolation cache entry {self._path(key)}")
+            return None
+        return filled
+
+    def put(self, ppds: list[PosteriorPoleData], filled: np.ndarray):
+        key = self.series_key(ppds)
+        if key is None: return
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as outf:
+            np.save(outf, np.asarray(filled, dtype=float))
+        os.replace(tmp_path, self._path(key))
+
+    def __len__(self):
+        return sum(1 for f in os.listdir(self.cache_dir) if f[-4:] == ".npy")
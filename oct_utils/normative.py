@@ -0,0 +1,167 @@
+"""
+Age-binned normative reference maps, built once from the controls.
+
+For each age bin, the per-cell mean, standard deviation and a table of percentiles
+of the control maps are kept as compact float32 arrays, so any number of patient
+scans can be placed against the controls without going back to the controls table.
+The reference keeps a fingerprint of the control scans it was built from, so that
+a reference saved before the controls changed is not used by mistake.
+"""
+import hashlib
+
+import numpy as np
+
+from oct_utils.cohort import stack_ages, stack_maps
+from oct_utils.data_structures import PosteriorPoleData
+
+DEFAULT_PERCENTILES = np.arange(1, 100, dtype=float)
+MIN_CONTROLS_PER_BIN = 3
+
+
+def merge_sparse_bins(age_edges: np.ndarray, ages: np.ndarray, min_count: int) -> np.ndarray:
+    """
+    The age edges without the ones between a bin of fewer than min_count controls and its
+    smaller neighbour, until every bin has enough controls (the outer edges are kept).
+    """
+    edges = list(np.asarray(age_edges, dtype=float))
+    while len(edges) > 2:
+        bins = np.clip(np.searchsorted(edges, ages, side="right") - 1, 0, len(edges) - 2)
+        counts = np.bincount(bins, minlength=len(edges) - 1)
+        sparse = int(np.argmin(counts))
+        if counts[sparse] >= min_count: break
+        if sparse == 0 or (sparse < len(counts) - 1 and counts[sparse + 1] <= counts[sparse - 1]):
+            del edges[sparse + 1]  # merged with the next bin
+        else:
+            del edges[sparse]      # merged with the previous bin
+    return np.array(edges)
+
+
+def controls_fingerprint(file_md5s) -> str:
+    """ Hash of the (md5s of the) control scans, in any order. """
+    return hashlib.sha256("\n".join(sorted(file_md5s)).encode()).hexdigest()
+
+
+class NormativeReference:
+    """
+    Usage:
+        reference = NormativeReference.build(control_maps, control_ages, bin_width=2.0)
+        reference.save(f"{scratch_dir}/normative_reference.npz")
+        ...
+        reference = NormativeReference.load(f"{scratch_dir}/normative_reference.npz",
+                                            controls_fingerprint(store.file_md5s()))
+        z = reference.zscores(patient_maps, patient_ages)           # (N, 8, 8)
+        pct = reference.percentiles(patient_maps, patient_ages)     # (N, 8, 8), in 0-100
+    """
+
+    def __init__(self, age_edges: np.ndarray, counts: np.ndarray, mean: np.ndarray, sd: np.ndarray,
+                 percentile_levels: np.ndarray, percentile_table: np.ndarray, fingerprint: str = ""):
+        self.age_edges = np.asarray(age_edges, dtype=float)                    # (B+1,)
+        self.counts = np.asarray(counts, dtype=np.int32)                      # (B,)
+        self.mean = np.asarray(mean, dtype=np.float32)                        # (B, 8, 8)
+        self.sd = np.asarray(sd, dtype=np.float32)                            # (B, 8, 8)
+        self.percentile_levels = np.asarray(percentile_levels, dtype=float)  # (L,)
+        self.percentile_table = np.asarray(percentile_table, dtype=np.float32)  # (B, L, 8, 8)
+        self.fingerprint = fingerprint  # controls_fingerprint of the controls; "" if not known
+
+    @classmethod
+    def build(cls, maps: np.ndarray, ages: np.ndarray, age_edges: np.ndarray | None = None,
+              bin_width: float = 2.0, percentile_levels: np.ndarray = DEFAULT_PERCENTILES,
+              min_count: int = MIN_CONTROLS_PER_BIN) -> "NormativeReference":
+        """
+        Parameters:
+        -----------
+        maps : array
+            Control maps, shape (N, 8, 8); NaN where missing
+        ages : array
+            Age at test for each map
+        age_edges : array or None
+            Bin edges in years; if None, bins of bin_width spanning the control ages
+        percentile_levels : array
+            Percentiles to tabulate, in 0-100
+        min_count : int
+            Bins with fewer controls than this are merged with their neighbours, so that
+            no scan is placed in a bin without norms; raises ValueError if there are fewer controls in all
+        """
+        maps = np.asarray(maps, dtype=float)
+        ages = np.asarray(ages, dtype=float)
+        if len(ages) < min_count:
+            raise ValueError(f"A normative reference needs at least {min_count} control scans, got {len(ages)}")
+        if age_edges is None:
+            low = np.floor(ages.min())
+            age_edges = np.arange(low, ages.max() + bin_width, bin_width)
+            if len(age_edges) < 2: age_edges = np.array([low, low + bin_width])
+        age_edges = merge_sparse_bins(age_edges, ages, min_count)
+        n_bins = len(age_edges) - 1
+        bins = np.clip(np.searchsorted(age_edges, ages, side="right") - 1, 0, n_bins - 1)
+
+        counts = np.bincount(bins, minlength=n_bins)
+        mean = np.full((n_bins,) + maps.shape[1:], np.nan)
+        sd = np.full((n_bins,) + maps.shape[1:], np.nan)
+        table = np.full((n_bins, len(percentile_levels)) + maps.shape[1:], np.nan)
+        for b in range(n_bins):  # every bin has at least min_count controls
+            in_bin = maps[bins == b]
+            mean[b] = np.nanmean(in_bin, axis=0)
+            sd[b] = np.nanstd(in_bin, axis=0, ddof=1)
+            table[b] = np.nanpercentile(in_bin, percentile_levels, axis=0)
+
+        return cls(age_edges, counts, mean, sd, percentile_levels, table)
+
+    @classmethod
+    def from_ppds(cls, ppds: list[PosteriorPoleData], map_name: str = "interpolated_map",
+                  **kwargs) -> "NormativeReference":
+        reference = cls.build(stack_maps(ppds, map_name), stack_ages(ppds), **kwargs)
+        reference.fingerprint = controls_fingerprint(ppd.filename_md5 for ppd in ppds)
+        return reference
+
+    def save(self, path: str):
+        np.savez_compressed(path, age_edges=self.age_edges, counts=self.counts, mean=self.mean, sd=self.sd,
+                            percentile_levels=self.percentile_levels, percentile_table=self.percentile_table,
+                            fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, path: str, fingerprint: str | None = None) -> "NormativeReference":
+        """ Raises ValueError if a fingerprint is given, and the reference was not built from those controls. """
+        with np.load(path) as data:
+            saved_fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else ""
+            if fingerprint is not None and saved_fingerprint != fingerprint:
+                raise ValueError(f"{path} was not built from the current controls")
+            return cls(data["age_edges"], data["counts"], data["mean"], data["sd"],
+                       data["percentile_levels"], data["percentile_table"], saved_fingerprint)
+
+    ###########################
+    def age_bins(self, ages) -> np.ndarray:
+        """ Bin index for each age; the ages outside of the range go to the first/last bin. """
+        n_bins = len(self.age_edges) - 1
+        return np.clip(np.searchsorted(self.age_edges, np.asarray(ages, dtype=float), side="right") - 1,
+                       0, n_bins - 1)
+
+    def zscores(self, maps: np.ndarray, ages) -> np.ndarray:
+        """ Per-cell z-scores of maps (N, 8, 8) against the controls of the same age bin. """
+        bins = self.age_bins(ages)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (np.asarray(maps, dtype=float) - self.mean[bins]) / self.sd[bins]
+
+    def percentiles(self, maps: np.ndarray, ages) -> np.ndarray:
+        """
+        Per-cell percentile (0-100) of maps (N, 8, 8) among the controls of the same age bin,
+        linearly interpolated between the tabulated levels. Values below the lowest (above the highest)
+        tabulated level come out as 0 (100); NaN where either the map or the bin is missing.
+        """
+        maps = np.asarray(maps, dtype=float)
+        table = self.percentile_table[self.age_bins(ages)]                  # (N, L, 8, 8)
+        levels = self.percentile_levels
+        n_levels = len(levels)
+
+        # how many tabulated values are below each cell - constant work per scan
+        rank = np.sum(table <= maps[:, None], axis=1)                       # (N, 8, 8), in 0..L
+        lower_idx = np.clip(rank - 1, 0, n_levels - 1)
+        upper_idx = np.clip(rank, 0, n_levels - 1)
+        lower = np.take_along_axis(table, lower_idx[:, None], axis=1)[:, 0]
+        upper = np.take_along_axis(table, upper_idx[:, None], axis=1)[:, 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(upper > lower, (maps - lower) / (upper - lower), 0.0)
+        pct = levels[lower_idx] + fraction * (levels[upper_idx] - levels[lower_idx])
+        pct = np.where(rank == 0, 0.0, np.where(rank == n_levels, 100.0, pct))
+
+        missing = np.isnan(maps) | np.isnan(table[:, 0])
+        return np.where(missing, np.nan, pct)
@@ -0,0 +1,234 @@
+"""
+A small, local, stage-memoized pipeline runner.
+
+The stages form a DAG. Each stage's fingerprint is a hash of the stage's function,
+its parameters, the state of its declared input files/directories (paths, sizes and
+modification times) and the fingerprints of the stages it depends on. After a stage
+succeeds, its fingerprint is written to a stamp file; the next run skips every stage
+whose stamp matches and whose outputs are all present, unless a stage upstream of it runs.
+
+The stages whose dependencies are done run at the same time in a pool of local processes
+(e.g. the controls and the patients groups).
+"""
+import hashlib
+import json
+import os
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+STAMP_DIR_NAME = ".pipeline_stamps"
+
+# stage statuses reported by Pipeline.run()
+UP_TO_DATE = "up to date"
+DONE = "done"
+FAILED = "failed"
+BLOCKED = "blocked"  # an upstream stage failed
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable, kwargs: dict | None = None, inputs: list[str] | None = None,
+                 outputs: list[str] | None = None, depends_on: list[str] | None = None, options: dict | None = None):
+        """
+        Parameters:
+        -----------
+        name : str
+            Unique name of the stage, e.g. "interpolate:controls"
+        func : callable
+            Module-level function (it is sent to a worker process), called as func(**kwargs)
+        inputs : list[str]
+            Files or directories the stage reads, other than the outputs of the upstream stages
+        outputs : list[str]
+            Files or directories the stage writes; the stage is re-run if any of them is missing
+        depends_on : list[str]
+            Names of the upstream stages
+        options : dict
+            Further keyword arguments of func that do not change its outputs (e.g. resume=True);
+            unlike kwargs, they are not part of the stage's fingerprint
+        """
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.depends_on = depends_on or []
+        self.options = options or {}
+
+    def __repr__(self):
+        return f"Stage({self.name})"
+
+
+def path_fingerprint(path: str) -> list:
+    """ Path, size and modification time of a file, or of every file under a directory. """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [[path, stat.st_size, stat.st_mtime_ns]]
+    if os.path.isdir(path):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                stat = os.stat(os.path.join(dirpath, filename))
+                entries.append([os.path.relpath(os.path.join(dirpath, filename), path), stat.st_size, stat.st_mtime_ns])
+        return [[path, entries]]
+    return [[path, "missing"]]
+
+
+def _run_stage(func: Callable, kwargs: dict):
+    return func(**kwargs)
+
+
+class Pipeline:
+    """
+    Usage:
+        pipeline = Pipeline([Stage("a", func_a, outputs=["a.out"]),
+                             Stage("b", func_b, depends_on=["a"])], state_dir=scratch_dir)
+        statuses = pipeline.run(max_workers=2)     # {"a": "done", "b": "done"}
+        statuses = pipeline.run()                  # {"a": "up to date", "b": "up to date"}
+    """
+
+    def __init__(self, stages: list[Stage], state_dir: str):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Stage {stage.name} defined twice")
+            self.stages[stage.name] = stage
+        for stage in stages:
+            for upstream in stage.depends_on:
+                if upstream not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on an undefined stage {upstream}")
+        self.order = self._topological_order()
+        self.stamp_dir = f"{state_dir}/{STAMP_DIR_NAME}"
+
+    def _topological_order(self) -> list[str]:
+        order = []
+        state = {}  # name -> "visiting" or "visited"
+
+        def visit(name: str):
+            if state.get(name) == "visited": return
+            if state.get(name) == "visiting":
+                raise ValueError(f"The stages form a cycle through {name}")
+            state[name] = "visiting"
+            for upstream in self.stages[name].depends_on:
+                visit(upstream)
+            state[name] = "visited"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def upstream_closure(self, targets: list[str]) -> set[str]:
+        """ The targets and all stages they (indirectly) depend on. """
+        selected = set()
+        to_visit = list(targets)
+        while to_visit:
+            name = to_visit.pop()
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}")
+            if name in selected: continue
+            selected.add(name)
+            to_visit.extend(self.stages[name].depends_on)
+        return selected
+
+    ###########################
+    def fingerprints(self) -> dict[str, str]:
+        fingerprints = {}
+        for name in self.order:
+            stage = self.stages[name]
+            description = {
+                "name": stage.name,
+                "func": f"{stage.func.__module__}.{stage.func.__qualname__}",
+                "kwargs": {key: repr(value) for key, value in sorted(stage.kwargs.items())},
+                "inputs": [entry for path in stage.inputs for entry in path_fingerprint(path)],
+                "upstream": [fingerprints[upstream] for upstream in stage.depends_on],
+            }
+            fingerprints[name] = hashlib.sha256(json.dumps(description).encode()).hexdigest()
+        return fingerprints
+
+    def _stamp_path(self, name: str) -> str:
+        return f"{self.stamp_dir}/{name.replace('/', '_').replace(':', '.')}.json"
+
+    def is_up_to_date(self, name: str, fingerprint: str) -> bool:
+        if not all(os.path.exists(output) for output in self.stages[name].outputs): return False
+        try:
+            with open(self._stamp_path(name)) as inf:
+                return json.load(inf)["fingerprint"] == fingerprint
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _write_stamp(self, name: str, fingerprint: str):
+        os.makedirs(self.stamp_dir, exist_ok=True)
+        tmp_path = f"{self._stamp_path(name)}.tmp"
+        with open(tmp_path, "w") as outf:
+            json.dump({"stage": name, "fingerprint": fingerprint}, outf)
+        os.replace(tmp_path, self._stamp_path(name))
+
+    ###########################
+    def plan(self, targets: list[str] | None = None, force: list[str] | bool = False,
+             fingerprints: dict[str, str] | None = None) -> dict[str, bool]:
+        """ For each selected stage (in dependency order): True if it needs to run. """
+        selected = self.upstream_closure(targets) if targets else set(self.order)
+        if fingerprints is None: fingerprints = self.fingerprints()
+        forced = set(selected) if force is True else set(force or [])
+        plan = {}
+        for name in self.order:
+            if name not in selected: continue
+            plan[name] = name in forced or not self.is_up_to_date(name, fingerprints[name])
+            # whatever is downstream of a stage that runs is rebuilt from its new outputs
+            plan[name] |= any(plan.get(upstream, False) for upstream in self.stages[name].depends_on)
+        return plan
+
+    def run(self, targets: list[str] | None = None, force: list[str] | bool = False,
+            max_workers: int | None = None) -> dict[str, str]:
+        """
+        Run the stages that are not up to date; the independent ones at the same time.
+
+        Parameters:
+        -----------
+        targets : list[str] or None
+            Run only these stages, and whatever they depend on (default: all stages)
+        force : list[str] or bool
+            Stages to re-run even if up to date (True: all selected stages)
+        max_workers : int or None
+            Number of stages running at the same time
+
+        Returns:
+        --------
+        dict
+            stage name -> status (UP_TO_DATE, DONE, FAILED or BLOCKED)
+        """
+        fingerprints = self.fingerprints()
+        plan = self.plan(targets, force, fingerprints)
+        statuses = {name: UP_TO_DATE for name, needs_run in plan.items() if not needs_run}
+        pending = [name for name, needs_run in plan.items() if needs_run]
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    upstream_statuses = [statuses.get(upstream) for upstream in self.stages[name].depends_on
+                                         if upstream in plan]
+                    if any(status in (FAILED, BLOCKED) for status in upstream_statuses):
+                        statuses[name] = BLOCKED
+                        pending.remove(name)
+                        print(f"{name}: blocked by a failed upstream stage")
+                    elif all(status in (UP_TO_DATE, DONE) for status in upstream_statuses):
+                        stage = self.stages[name]
+                        print(f"{name}: running")
+                        running[pool.submit(_run_stage, stage.func, {**stage.kwargs, **stage.options})] = name
+                        pending.remove(name)
+                if not running: continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        statuses[name] = FAILED
+                        print(f"{name}: failed: {e!r}")
+                        continue
+                    self._write_stamp(name, fingerprints[name])
+                    statuses[name] = DONE
+                    print(f"{name}: done")
+
+        return {name: statuses[name] for name in plan}
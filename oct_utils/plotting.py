@@ -1,12 +1,20 @@
 
 
 import numpy as np
-from matplotlib import pyplot as plt
 
+from oct_utils.conventions import alias_dir_name
 from oct_utils.data_structures import PosteriorPoleData
 
 
+def thickness_map_name(ppd: PosteriorPoleData, thck_map: str = "original") -> str:
+    outname  = f"{alias_dir_name(ppd.alias)}_{ppd.laterality}_"
+    outname += f"{str(ppd.age_at_test).replace('.', '_')}.{thck_map}.png"
+    return outname
+
+
 def plot_thickness_map(ppd: PosteriorPoleData, scratch_dir: str, thck_map: str="original"):
+    from matplotlib import pyplot as plt
+
     plt.figure()
     plt.title(f"{ppd.alias}, {ppd.age_at_test} {ppd.laterality} ({thck_map})")
     df = ppd.pp_map if thck_map == "original" else ppd.interpolated_map
@@ -16,8 +24,7 @@ def plot_thickness_map(ppd: PosteriorPoleData, scratch_dir: str, thck_map: str="
     plt.xlabel("Temporal-Nasal")
     plt.ylabel("Inferior-Superior")
     plt.colorbar(label="Avg thickness (mm)")  # Show color scale
-    outname  = f"{ppd.alias.replace(' ', '_')}_{ppd.laterality}_"
-    outname += f"{str(ppd.age_at_test).replace('.', '_')}.{thck_map}.png"
+    outname = thickness_map_name(ppd, thck_map)
     plt.savefig(f"{scratch_dir}/{outname}")
     plt.close()
     print(f"wrote {scratch_dir}/{outname}")
@@ -26,6 +33,8 @@ def plot_thickness_map(ppd: PosteriorPoleData, scratch_dir: str, thck_map: str="
 def plot_avg_thickness_vs_time(age_at_test, wavg, wavg_interp=None, wavg_interp_inner=None,
                                total_volume=None, xrange: list[float] | None = None, yrange: list[float] | None = None,
                                title: str | None = None, out_name: str | None = None):
+    from matplotlib import pyplot as plt
+
     fig, ax = plt.subplots()
     if title is not None:
         ax.set_title(title)
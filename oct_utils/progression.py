@@ -0,0 +1,115 @@
+"""
+Visit-to-visit progression: how each zone of the (interpolated) map changes over time.
+
+For every scan of every alias/eye series, with the scans of the series sorted by age:
+    delta_previous   change since the previous visit (um); NaN for the first visit
+    rate_previous    the same per year (um/year); NaN where the visits are less than MIN_RATE_INTERVAL apart
+    delta_baseline   change since the first visit (um); 0 for the first visit itself
+    rate_baseline    the same per year (um/year); NaN for the first visit, and for the visits
+                     less than MIN_RATE_INTERVAL after it
+Over a few days, the measurement noise divided by the interval makes meaningless rates
+of hundreds or thousands of um/year, hence the minimum interval.
+All of it is computed at once on the stacked cohort arrays: the scans are sorted by series
+and age, and each scan's previous and baseline scans are found by index arithmetic.
+"""
+from collections.abc import Hashable, Sequence
+
+import numpy as np
+
+from oct_utils.cohort import series_labels, stack_ages, stack_maps
+from oct_utils.data_structures import PosteriorPoleData
+
+PROGRESSION_TABLE_NAME = "progression_maps"
+PROGRESSION_MAPS = ["delta_previous", "rate_previous", "delta_baseline", "rate_baseline"]
+# the differences of float maps are not whole numbers of any i2 unit (see oct_utils.compact_maps)
+PROGRESSION_CODEC = "f4"
+MIN_RATE_INTERVAL = 30 / 365.25  # years
+MM_TO_UM = 1000.0
+
+
+class ProgressionMaps:
+    """
+    Usage:
+        progression = ProgressionMaps.from_ppds(store.query_ppds())
+        progression.rate_baseline          # (N, 8, 8) um/year, in the order of the ppds
+        store.upsert_progression(progression)
+    """
+
+    def __init__(self, file_md5s: list[str], previous_md5s: list[str | None], baseline_md5s: list[str],
+                 years_since_previous: np.ndarray, years_since_baseline: np.ndarray,
+                 delta_previous: np.ndarray, rate_previous: np.ndarray,
+                 delta_baseline: np.ndarray, rate_baseline: np.ndarray):
+        self.file_md5s = file_md5s
+        self.previous_md5s = previous_md5s  # None for the first visit
+        self.baseline_md5s = baseline_md5s
+        self.years_since_previous = years_since_previous
+        self.years_since_baseline = years_since_baseline
+        self.delta_previous = delta_previous
+        self.rate_previous = rate_previous
+        self.delta_baseline = delta_baseline
+        self.rate_baseline = rate_baseline
+
+    def __len__(self):
+        return len(self.file_md5s)
+
+    @classmethod
+    def compute(cls, maps: np.ndarray, ages: np.ndarray, labels: Sequence[Hashable],
+                file_md5s: list[str] | None = None, min_rate_interval: float = MIN_RATE_INTERVAL) -> "ProgressionMaps":
+        """
+        Parameters:
+        -----------
+        maps : array
+            (N, 8, 8) thickness maps in mm, in any order
+        ages : array
+            (N,) age at each scan
+        labels : list
+            the series of each scan, e.g. (patient_id, eye)
+        min_rate_interval : float
+            no rates (NaN) over intervals shorter than this, in years
+
+        Returns:
+        --------
+        ProgressionMaps
+            everything in the order of the input scans
+        """
+        maps = np.asarray(maps, dtype=float)
+        ages = np.asarray(ages, dtype=float)
+        n_scans = len(ages)
+        series_index = {}
+        series = np.array([series_index.setdefault(label, len(series_index)) for label in labels], dtype=int)
+
+        # sorted by series, then age: each series is a run of consecutive positions
+        order = np.lexsort((ages, series))
+        positions = np.arange(n_scans)
+        first = np.ones(n_scans, dtype=bool)
+        first[1:] = series[order][1:] != series[order][:-1]
+        run_start = np.maximum.accumulate(np.where(first, positions, 0))
+
+        previous_index = np.full(n_scans, -1)
+        previous_index[order[~first]] = order[positions[~first] - 1]
+        baseline_index = np.empty(n_scans, dtype=int)
+        baseline_index[order] = order[run_start]
+
+        has_previous = previous_index >= 0
+        previous = np.where(has_previous, previous_index, positions)
+        years_since_previous = np.where(has_previous, ages - ages[previous], np.nan)
+        years_since_baseline = ages - ages[baseline_index]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta_previous = np.where(has_previous[:, None, None], (maps - maps[previous]) * MM_TO_UM, np.nan)
+            delta_baseline = (maps - maps[baseline_index]) * MM_TO_UM
+            rate_previous = np.where((years_since_previous >= min_rate_interval)[:, None, None],
+                                     delta_previous / years_since_previous[:, None, None], np.nan)
+            rate_baseline = np.where((years_since_baseline >= min_rate_interval)[:, None, None],
+                                     delta_baseline / years_since_baseline[:, None, None], np.nan)
+
+        if file_md5s is None: file_md5s = [None] * n_scans
+        previous_md5s = [file_md5s[i] if i >= 0 else None for i in previous_index]
+        baseline_md5s = [file_md5s[i] for i in baseline_index]
+        return cls(list(file_md5s), previous_md5s, baseline_md5s, years_since_previous, years_since_baseline,
+                   delta_previous, rate_previous, delta_baseline, rate_baseline)
+
+    @classmethod
+    def from_ppds(cls, ppds: list[PosteriorPoleData], map_name: str = "interpolated_map") -> "ProgressionMaps":
+        return cls.compute(stack_maps(ppds, map_name), stack_ages(ppds), series_labels(ppds),
+                           [ppd.filename_md5 for ppd in ppds])
@@ -0,0 +1,143 @@
+"""
+Quality control of the scans, before any work is spent on them.
+
+All scans of a batch are checked at once, on the stacked maps (N, 8, 8):
+    low_valid_pct     too many zones with a low ValidPixelPercentage
+    missing_zones     too many zones without a thickness
+    out_of_range      a thickness no retina can have
+    spatial_outliers  too many zones that differ wildly from the median of their neighbours
+    choroid           the choroid_ok flag is off (choroid thicker than the cutoff); only if asked for
+A scan failing any of the checks is rejected. The default thresholds are a starting point,
+not validated cutoffs, which is why the gate is off unless asked for (see 02_interpolate.py --qc).
+
+The checks run per alias/eye series, once all of its files are parsed (see oct_utils.ingestion):
+on the stacked maps, which the parse worker has already compacted, and with the md5 of the single
+read of each file, for the report. A rejected scan is neither interpolated nor stored.
+"""
+import hashlib
+import inspect
+import json
+import warnings
+
+import numpy as np
+
+from oct_utils.cohort import stack_maps
+from oct_utils.data_structures import PosteriorPoleData
+
+QC_CHECKS = ["low_valid_pct", "missing_zones", "out_of_range", "spatial_outliers", "choroid"]
+
+MIN_ZONE_VALID_PCT = 50.0         # zones below this ValidPixelPercentage count as poorly measured
+MAX_LOW_VALID_FRACTION = 0.5      # of the 64 zones
+MAX_MISSING_FRACTION = 0.5        # of the 64 zones
+THICKNESS_RANGE_MM = (0.05, 1.0)
+MAX_NEIGHBOUR_DEVIATION_MM = 0.2  # from the median of the (up to 8) neighbouring zones
+MAX_OUTLIER_ZONES = 3
+
+
+def neighbour_median(maps: np.ndarray) -> np.ndarray:
+    """ (N, 8, 8) median of the up to 8 neighbours of each zone, ignoring the missing ones. """
+    (n_maps, n_rows, n_cols) = maps.shape
+    padded = np.pad(np.asarray(maps, dtype=float), ((0, 0), (1, 1), (1, 1)), constant_values=np.nan)
+    shifts = [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if (dr, dc) != (0, 0)]
+    neighbours = np.stack([padded[:, 1 + dr:1 + dr + n_rows, 1 + dc:1 + dc + n_cols] for dr, dc in shifts], axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # zones without any neighbour -> NaN
+        return np.nanmedian(neighbours, axis=-1)
+
+
+def qc_checks(maps: np.ndarray, valid_pct: np.ndarray, choroid_ok: np.ndarray | None = None,
+              min_zone_valid_pct: float = MIN_ZONE_VALID_PCT, max_low_valid_fraction: float = MAX_LOW_VALID_FRACTION,
+              max_missing_fraction: float = MAX_MISSING_FRACTION,
+              thickness_range: tuple[float, float] = THICKNESS_RANGE_MM,
+              max_neighbour_deviation: float = MAX_NEIGHBOUR_DEVIATION_MM,
+              max_outlier_zones: int = MAX_OUTLIER_ZONES) -> dict[str, np.ndarray]:
+    """
+    Run all checks on a stack of scans.
+
+    Parameters:
+    -----------
+    maps : array
+        Thickness maps in mm (N, 8, 8); NaN where missing
+    valid_pct : array
+        ValidPixelPercentage of each zone (N, 8, 8)
+    choroid_ok : array or None
+        choroid_ok flag of each scan (N,); not checked if None
+
+    Returns:
+    --------
+    dict
+        check name (one of QC_CHECKS) -> (N,) bool array, True where the scan fails the check
+    """
+    maps = np.asarray(maps, dtype=float)
+    valid_pct = np.asarray(valid_pct, dtype=float)
+    n_zones = maps.shape[1] * maps.shape[2]
+    missing = np.isnan(maps)
+
+    deviation = np.abs(maps - neighbour_median(maps))
+    with np.errstate(invalid="ignore"):
+        out_of_range = (maps < thickness_range[0]) | (maps > thickness_range[1])
+        outliers = deviation > max_neighbour_deviation
+
+    failed = {
+        "low_valid_pct": np.sum(valid_pct < min_zone_valid_pct, axis=(1, 2)) > max_low_valid_fraction * n_zones,
+        "missing_zones": np.sum(missing, axis=(1, 2)) > max_missing_fraction * n_zones,
+        "out_of_range": np.any(out_of_range, axis=(1, 2)),
+        "spatial_outliers": np.sum(outliers, axis=(1, 2)) > max_outlier_zones,
+        "choroid": np.zeros(len(maps), dtype=bool) if choroid_ok is None else ~np.asarray(choroid_ok, dtype=bool),
+    }
+    return failed
+
+
+class QualityGate:
+    """
+    Usage:
+        gate = QualityGate(max_outlier_zones=2)
+        kept = gate.filter(ppds)          # any number of batches
+        ...
+        for ppd, reasons in gate.rejected:
+            print(ppd.filename, reasons)
+    """
+
+    def __init__(self, check_choroid: bool = False, **thresholds):
+        """
+        check_choroid: reject the scans whose choroid_ok flag is off
+        thresholds: keyword arguments of qc_checks(), overriding its defaults
+        """
+        self.check_choroid = check_choroid
+        self.thresholds = thresholds
+        self.rejected: list[tuple[PosteriorPoleData, list[str]]] = []
+        self.number_checked = 0
+        # (alias, eye) of each series seen by filter(), to tell its rows from those of an earlier report
+        self.checked_series: set[tuple[str, str]] = set()
+
+    def fingerprint(self) -> str:
+        """ md5 of the settings (including the default thresholds), to tell whether a stored series was gated alike. """
+        defaults = {name: parameter.default for name, parameter in inspect.signature(qc_checks).parameters.items()
+                    if parameter.default is not inspect.Parameter.empty and name != "choroid_ok"}
+        settings = {"check_choroid": self.check_choroid, **defaults, **self.thresholds}
+        return hashlib.md5(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def filter(self, ppds: list[PosteriorPoleData]) -> list[PosteriorPoleData]:
+        """ The scans that pass all checks; the others are added to self.rejected. """
+        if not ppds: return []
+        choroid_ok = np.array([ppd.choroid_ok for ppd in ppds], dtype=bool) if self.check_choroid else None
+        failed = qc_checks(stack_maps(ppds, "pp_map"), stack_maps(ppds, "weights"), choroid_ok, **self.thresholds)
+        failed_any = np.any(np.stack([failed[check] for check in QC_CHECKS]), axis=0)
+        self.number_checked += len(ppds)
+        self.checked_series.update((ppd.alias, ppd.laterality) for ppd in ppds)
+        kept = []
+        for i, ppd in enumerate(ppds):
+            if not failed_any[i]:
+                kept.append(ppd)
+                continue
+            reasons = [check for check in QC_CHECKS if failed[check][i]]
+            print(f"Warning: {ppd.alias} {ppd.laterality} {ppd.age_at_test} ({ppd.filename}) "
+                  f"failed QC: {', '.join(reasons)}")
+            self.rejected.append((ppd, reasons))
+        return kept
+
+    def report_rows(self) -> list[dict]:
+        """ One row per rejected scan, e.g. for a pandas DataFrame. """
+        return [{"alias": ppd.alias, "eye": ppd.laterality, "age_acquired": ppd.age_at_test,
+                 "file_name": ppd.filename, "file_md5": ppd.filename_md5, "reasons": ", ".join(reasons)}
+                for ppd, reasons in self.rejected]
@@ -0,0 +1,132 @@
+"""
+Cached binary copy of the reference spreadsheets (the Curcio photoreceptor densities).
+
+The legacy .xls workbook is converted once - all sheets, each column typed as float64
+if all of its values are numbers, as text otherwise - validated, and written as an .npz
+(no pickled objects) along with a manifest holding the md5 of the workbook. Every later load
+checks the md5 and reads the .npz; a changed workbook is converted again.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+REFERENCE_CACHE_VERSION = 2
+REFERENCE_CACHE_DIR = "data/cache"
+DENSITY_SHEETS = ["Rods per sq mm", "Cones per sq mm"]
+DENSITY_COLUMNS = ["mm", "deg", "superior", "inferior", "temporal", "nasal"]
+
+
+def source_md5(path: str) -> str:
+    with open(path, "rb") as inf:
+        return hashlib.md5(inf.read()).hexdigest()
+
+
+def _typed_column(values: pd.Series) -> tuple[str, np.ndarray]:
+    import pandas as pd
+
+    numeric = pd.to_numeric(values, errors="coerce")
+    if numeric.notna().sum() == values.notna().sum():
+        return "float", numeric.to_numpy(dtype=float)
+    return "str", np.array(["" if pd.isna(value) else str(value) for value in values], dtype=str)
+
+
+def validate_density_sheet(sheet_name: str, df: pd.DataFrame):
+    """ Raises ValueError if the sheet is not a radial density table as read_radial_data expects it. """
+    missing = [column for column in DENSITY_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"Sheet '{sheet_name}': missing columns {missing}")
+    values = df[DENSITY_COLUMNS].to_numpy(dtype=float)
+    if np.isnan(values[:, 0]).any() or np.any(np.diff(values[:, 0]) < 0):
+        raise ValueError(f"Sheet '{sheet_name}': the radii (mm) must be given, in increasing order")
+    if np.any(values[:, 2:] < 0):
+        raise ValueError(f"Sheet '{sheet_name}': negative densities")
+
+
+def convert_workbook(xls_path: str, cache_path: str, md5: str | None = None) -> dict[str, pd.DataFrame]:
+    """ Read all sheets of the workbook, validate them, and write the cache (atomically). """
+    import pandas as pd
+
+    sheets = pd.read_excel(xls_path, sheet_name=None)
+    for sheet_name in DENSITY_SHEETS:
+        if sheet_name not in sheets:
+            raise ValueError(f"{xls_path}: no sheet '{sheet_name}'")
+
+    manifest = {"version": REFERENCE_CACHE_VERSION, "source_md5": md5 or source_md5(xls_path), "sheets": []}
+    arrays = {}
+    typed_sheets = {}
+    for i, (sheet_name, df) in enumerate(sheets.items()):
+        typed = {str(column): _typed_column(df[column]) for column in df.columns}
+        sheet = {"name": sheet_name, "n_rows": len(df),
+                 "columns": [{"name": name, "dtype": dtype} for name, (dtype, _) in typed.items()]}
+        # one array per type and sheet: (n_rows, number of columns of the type)
+        for dtype in ["float", "str"]:
+            columns = [values for (column_dtype, values) in typed.values() if column_dtype == dtype]
+            if columns: arrays[f"s{i}_{dtype}"] = np.column_stack(columns)
+        manifest["sheets"].append(sheet)
+        typed_sheets[sheet_name] = _to_dataframe(sheet, {name: values for name, (_, values) in typed.items()})
+        if sheet_name in DENSITY_SHEETS: validate_density_sheet(sheet_name, typed_sheets[sheet_name])
+
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as outf:
+        np.savez(outf, manifest=np.array(json.dumps(manifest)), **arrays)
+    os.replace(tmp_path, cache_path)
+    print(f"converted {xls_path} to {cache_path}")
+    return typed_sheets
+
+
+def _to_dataframe(sheet: dict, columns: dict[str, np.ndarray]) -> pd.DataFrame:
+    import pandas as pd
+
+    data = {}
+    for column in sheet["columns"]:
+        values = columns[column["name"]]
+        data[column["name"]] = values if column["dtype"] == "float" else np.where(values == "", None, values)
+    return pd.DataFrame(data)
+
+
+def _read_cache(cache_path: str, md5: str, sheet_names: list[str] | None = None) -> dict[str, pd.DataFrame] | None:
+    """ The sheets (default: all) from the cache; None if there is no usable cache for this version of the workbook. """
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            manifest = json.loads(str(data["manifest"]))
+            if manifest["version"] != REFERENCE_CACHE_VERSION or manifest["source_md5"] != md5: return None
+            sheets = {}
+            for i, sheet in enumerate(manifest["sheets"]):
+                if sheet_names is not None and sheet["name"] not in sheet_names: continue
+                columns = {}
+                for dtype in ["float", "str"]:
+                    names = [column["name"] for column in sheet["columns"] if column["dtype"] == dtype]
+                    if not names: continue
+                    block = data[f"s{i}_{dtype}"]
+                    columns.update({name: block[:, j] for j, name in enumerate(names)})
+                sheets[sheet["name"]] = _to_dataframe(sheet, columns)
+            return sheets
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.exists(cache_path): print(f"Warning: ignoring the unreadable reference cache {cache_path}: {e}")
+        return None
+
+
+def load_reference_workbook(xls_path: str, cache_dir: str = REFERENCE_CACHE_DIR,
+                            sheet_names: list[str] | None = None) -> dict[str, pd.DataFrame]:
+    """ sheet name -> DataFrame, for the given (default: all) sheets of the workbook; from the cache if it is up to date. """
+    cache_path = f"{cache_dir}/{os.path.basename(xls_path)}.npz"
+    md5 = source_md5(xls_path)
+    sheets = _read_cache(cache_path, md5, sheet_names)
+    if sheets is None: sheets = convert_workbook(xls_path, cache_path, md5)
+    return sheets if sheet_names is None else {name: sheets[name] for name in sheet_names if name in sheets}
+
+
+def load_reference_sheet(xls_path: str, sheet_name: str, cache_dir: str = REFERENCE_CACHE_DIR) -> pd.DataFrame:
+    sheets = load_reference_workbook(xls_path, cache_dir, [sheet_name])
+    if sheet_name not in sheets:
+        raise ValueError(f"{xls_path}: no sheet '{sheet_name}'")
+    return sheets[sheet_name]
@@ -0,0 +1,443 @@
+"""
+SQLite-backed store for the results passed between the pipeline stages.
+
+The maps are stored as BLOBs of packed little-endian arrays (row-major, 8x8), float64
+or, with a compact codec, float32 or int16 (see oct_utils.compact_maps), so a single
+scan can be fetched without decoding anything else in the table. The blobs of all codecs
+can be mixed in the same table: each is read according to its length.
+All thickness grids of each scan (oct_utils.thickness_grids), and the progression
+maps (oct_utils.progression), are kept in tables of their own, encoded the same way.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from oct_utils.compact_maps import DEFAULT_SCALE, MAP_SCALES, CompactMap, encode
+from oct_utils.data_structures import PosteriorPoleData
+from oct_utils.identity import IdentityIndex
+from oct_utils.progression import PROGRESSION_CODEC, PROGRESSION_MAPS, PROGRESSION_TABLE_NAME, ProgressionMaps
+from oct_utils.thickness_grids import GRID_SCALES, GRID_VALUES, THICKNESS_GRIDS_TABLE_NAME, ThicknessGrid
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+SCORES_TABLE_NAME = "avg_retinal_thickness"
+PATIENTS_TABLE_NAME = "patients"
+COMPLETED_SERIES_TABLE_NAME = "completed_series"
+MAP_SHAPE = (8, 8)
+
+
+def pack_map(thck_map: pd.DataFrame | np.ndarray | CompactMap | None, codec: str = "f8",
+             scale: float = DEFAULT_SCALE) -> bytes | None:
+    if thck_map is None: return None
+    if isinstance(thck_map, CompactMap):
+        # (a map already compacted with "auto" is either i2 or f4)
+        if thck_map.codec == codec or (codec == "auto" and thck_map.codec != "f8"): return thck_map.to_bytes()
+        thck_map = thck_map.to_array()
+    return encode(thck_map, codec, scale).tobytes()
+
+
+def unpack_map(blob: bytes | None, scale: float = DEFAULT_SCALE) -> pd.DataFrame | None:
+    if blob is None: return None
+    return CompactMap.from_bytes(blob, MAP_SHAPE, scale)()
+
+
+def blob_to_map(blob: bytes | None, scale: float = DEFAULT_SCALE) -> CompactMap | None:
+    """ The map, still encoded, as a loader for the map attributes of PosteriorPoleData. """
+    if blob is None: return None
+    return CompactMap.from_bytes(blob, MAP_SHAPE, scale)
+
+
+class ResultStore:
+    """
+    Usage:
+        with ResultStore(f"{scratch_dir}/oct_results.{data_group}.sqlite") as store:
+            store.upsert_ppds(ppds)
+            for ppd in store.query_ppds(alias=alias, eye="OD"):
+                ...
+
+    With codec="i2", "f4" or "auto" the maps are written in a compact encoding;
+    the stores written with any codec are read the same way.
+    """
+    pp_table: str = PosteriorPoleData.table_name
+    scores_table: str = SCORES_TABLE_NAME
+    patients_table: str = PATIENTS_TABLE_NAME
+    completed_series_table: str = COMPLETED_SERIES_TABLE_NAME
+    grids_table: str = THICKNESS_GRIDS_TABLE_NAME
+    progression_table: str = PROGRESSION_TABLE_NAME
+
+    def __init__(self, db_path: str, codec: str = "f8"):
+        self.db_path = db_path
+        self.codec = codec
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self._create_tables()
+        self.identity = IdentityIndex(self.connection.execute(f"SELECT patient_id, alias FROM {self.patients_table}"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS {self.patients_table} (
+                    patient_id INTEGER PRIMARY KEY,
+                    alias      TEXT NOT NULL UNIQUE
+                );
+
+                CREATE TABLE IF NOT EXISTS {self.pp_table} (
+                    file_md5         TEXT PRIMARY KEY,
+                    patient_id       INTEGER NOT NULL REFERENCES {self.patients_table},
+                    alias            TEXT NOT NULL,
+                    eye              TEXT NOT NULL,
+                    age_acquired     REAL NOT NULL,
+                    file_name        TEXT,
+                    total_volume     REAL,
+                    choroid_ok       INTEGER,
+                    pp_map           BLOB,
+                    weights          BLOB,
+                    interpolated_map BLOB
+                );
+                CREATE INDEX IF NOT EXISTS {self.pp_table}_patient_eye_age
+                    ON {self.pp_table} (patient_id, eye, age_acquired);
+
+                CREATE TABLE IF NOT EXISTS {self.scores_table} (
+                    file_md5          TEXT PRIMARY KEY,
+                    patient_id        INTEGER NOT NULL REFERENCES {self.patients_table},
+                    alias             TEXT NOT NULL,
+                    eye               TEXT NOT NULL,
+                    age_acquired      REAL NOT NULL,
+                    file_name         TEXT,
+                    avg_thickness     REAL,
+                    wtd_avg_thickness REAL
+                );
+                CREATE INDEX IF NOT EXISTS {self.scores_table}_patient_eye_age
+                    ON {self.scores_table} (patient_id, eye, age_acquired);
+
+                -- all thickness grids of each scan (the 8x8 one included), as exported;
+                -- the shape is  n_rows x n_cols  for the "row,col" grids,  n_zones x NULL  for the others
+                CREATE TABLE IF NOT EXISTS {self.grids_table} (
+                    file_md5     TEXT NOT NULL,
+                    grid_name    TEXT NOT NULL,
+                    n_rows       INTEGER NOT NULL,
+                    n_cols       INTEGER,
+                    zone_names   TEXT NOT NULL,  -- json list
+                    total_volume REAL,
+                    thickness    BLOB NOT NULL,
+                    volume       BLOB NOT NULL,
+                    valid_pct    BLOB NOT NULL,
+                    PRIMARY KEY (file_md5, grid_name)
+                );
+
+                -- change of each scan's interpolated map since the previous and the first visit of its series;
+                -- the maps in um and um/year, NULL where all NaN (e.g. no previous visit)
+                CREATE TABLE IF NOT EXISTS {self.progression_table} (
+                    file_md5             TEXT PRIMARY KEY,
+                    previous_md5         TEXT,
+                    baseline_md5         TEXT NOT NULL,
+                    years_since_previous REAL,
+                    years_since_baseline REAL NOT NULL,
+                    delta_previous       BLOB,
+                    rate_previous        BLOB,
+                    delta_baseline       BLOB,
+                    rate_baseline        BLOB
+                );
+
+                -- the alias/eye series (as named by the xml directories) stored in full, for resuming
+                CREATE TABLE IF NOT EXISTS {self.completed_series_table} (
+                    alias_dir   TEXT NOT NULL,
+                    eye         TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    n_scans     INTEGER NOT NULL,
+                    PRIMARY KEY (alias_dir, eye)
+                );
+            """)
+
+    def _assign_patient_ids(self, ppds: Iterable[PosteriorPoleData]) -> list[PosteriorPoleData]:
+        """ Canonical alias and patient id for each scan; the new patients are added to the patients table. """
+        ppds = list(ppds)
+        for ppd in ppds:
+            ppd.patient_id = self.identity.id_of(ppd.alias)
+            ppd.alias = self.identity.alias(ppd.patient_id)
+        self.connection.executemany(f"INSERT OR IGNORE INTO {self.patients_table} (patient_id, alias) VALUES (?, ?)",
+                                    self.identity.items())
+        return ppds
+
+    ###########################
+    def upsert_ppds(self, ppds: Iterable[PosteriorPoleData]) -> int:
+        """ Insert the scans, or replace the ones with the same file_md5. Returns the number of rows written. """
+        with self.connection:
+            return self._upsert_ppd_rows(ppds)
+
+    def _upsert_ppd_rows(self, ppds: Iterable[PosteriorPoleData]) -> int:
+        # without committing
+        ppds = self._assign_patient_ids(ppds)
+        rows = [(ppd.filename_md5, ppd.patient_id, ppd.alias, ppd.laterality, ppd.age_at_test, ppd.filename, ppd.total_volume,
+                 ppd.choroid_ok, *[self._pack(ppd, map_name) for map_name in ["pp_map", "weights", "interpolated_map"]])
+                for ppd in ppds]
+        if any(row[0] is None for row in rows):
+            raise ValueError("file_md5 must be specified for every scan stored")
+        self.connection.executemany(f"""
+            INSERT INTO {self.pp_table} (file_md5, patient_id, alias, eye, age_acquired, file_name, total_volume,
+                                         choroid_ok, pp_map, weights, interpolated_map)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(file_md5) DO UPDATE SET
+                patient_id=excluded.patient_id, alias=excluded.alias, eye=excluded.eye, age_acquired=excluded.age_acquired,
+                file_name=excluded.file_name, total_volume=excluded.total_volume,
+                choroid_ok=excluded.choroid_ok, pp_map=excluded.pp_map, weights=excluded.weights,
+                interpolated_map=excluded.interpolated_map
+            """, rows)
+        grid_rows = [(ppd.filename_md5, *self._grid_row(grid)) for ppd in ppds for grid in ppd.thickness_grids.values()]
+        self.connection.executemany(f"INSERT OR REPLACE INTO {self.grids_table} "
+                                    f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", grid_rows)
+        return len(rows)
+
+    def _grid_row(self, grid: ThicknessGrid) -> tuple:
+        (n_rows, n_cols) = grid.shape if grid.is_2d else (grid.shape[0], None)
+        return (grid.name, n_rows, n_cols, json.dumps(grid.zone_names), grid.total_volume,
+                *[pack_map(getattr(grid, value_name), self.codec, GRID_SCALES[value_name]) for value_name in GRID_VALUES])
+
+    def commit_series(self, alias_dir: str, eye: str, ppds: list[PosteriorPoleData],
+                      fingerprint: str | None = None) -> int:
+        """
+        Checkpoint one alias/eye series in a single transaction: a crash leaves either all of it or none of it.
+        With a fingerprint (i.e. all files of the series were processed), the series also replaces whatever
+        was stored for it before and is marked completed, so that a resumed run can skip it.
+        Returns the number of scans written.
+        """
+        with self.connection:
+            number_written = self._upsert_ppd_rows(ppds)
+            if fingerprint is None: return number_written
+            patient_id = self.identity.id_of(alias_dir)
+            self.connection.executemany(f"INSERT OR IGNORE INTO {self.patients_table} (patient_id, alias) VALUES (?, ?)",
+                                        self.identity.items())
+            # the scans of files that are gone from the series (or now fail QC), and their scores
+            md5s = [ppd.filename_md5 for ppd in ppds]
+            for table in [self.grids_table, self.progression_table]:
+                self.connection.execute(f"DELETE FROM {table} WHERE file_md5 IN "
+                                        f"(SELECT file_md5 FROM {self.pp_table} WHERE patient_id = ? AND eye = ? "
+                                        f"AND file_md5 NOT IN ({', '.join('?' * len(md5s))}))", [patient_id, eye, *md5s])
+            for table in [self.pp_table, self.scores_table]:
+                self.connection.execute(f"DELETE FROM {table} WHERE patient_id = ? AND eye = ? "
+                                        f"AND file_md5 NOT IN ({', '.join('?' * len(md5s))})", [patient_id, eye, *md5s])
+            self.connection.execute(f"INSERT OR REPLACE INTO {self.completed_series_table} "
+                                    f"(alias_dir, eye, fingerprint, n_scans) VALUES (?, ?, ?, ?)",
+                                    (alias_dir, eye, fingerprint, number_written))
+        return number_written
+
+    def merge_from(self, other_db_path: str) -> int:
+        """
+        Copy all scans, thickness grids, progression maps, scores and completed series of another store (e.g. of a shard) into this one,
+        replacing the rows with the same file_md5. The maps are copied as they are, without decoding;
+        the patient ids are reassigned by alias. Returns the number of scans copied.
+        """
+        self.connection.execute("ATTACH DATABASE ? AS other", (other_db_path,))
+        try:
+            with self.connection:
+                other_patients = self.connection.execute(f"SELECT patient_id, alias FROM other.{self.patients_table}")
+                id_map = [(patient_id, self.identity.id_of(alias)) for patient_id, alias in other_patients.fetchall()]
+                self.connection.executemany(f"INSERT OR IGNORE INTO {self.patients_table} (patient_id, alias) VALUES (?, ?)",
+                                            self.identity.items())
+                self.connection.execute("CREATE TEMP TABLE id_map (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+                self.connection.executemany("INSERT INTO temp.id_map VALUES (?, ?)", id_map)
+                number_copied = self.connection.execute(f"""
+                    INSERT OR REPLACE INTO {self.pp_table} (file_md5, patient_id, alias, eye, age_acquired, file_name,
+                                                            total_volume, choroid_ok, pp_map, weights, interpolated_map)
+                    SELECT s.file_md5, m.new_id, s.alias, s.eye, s.age_acquired, s.file_name,
+                           s.total_volume, s.choroid_ok, s.pp_map, s.weights, s.interpolated_map
+                    FROM other.{self.pp_table} s JOIN temp.id_map m ON s.patient_id = m.old_id""").rowcount
+                self.connection.execute(f"""
+                    INSERT OR REPLACE INTO {self.scores_table} (file_md5, patient_id, alias, eye, age_acquired, file_name,
+                                                                avg_thickness, wtd_avg_thickness)
+                    SELECT s.file_md5, m.new_id, s.alias, s.eye, s.age_acquired, s.file_name,
+                           s.avg_thickness, s.wtd_avg_thickness
+                    FROM other.{self.scores_table} s JOIN temp.id_map m ON s.patient_id = m.old_id""")
+                for table in [self.grids_table, self.progression_table]:
+                    self.connection.execute(f"INSERT OR REPLACE INTO {table} SELECT * FROM other.{table}")
+                self.connection.execute(f"INSERT OR REPLACE INTO {self.completed_series_table} "
+                                        f"SELECT * FROM other.{self.completed_series_table}")
+                self.connection.execute("DROP TABLE temp.id_map")
+        finally:
+            self.connection.execute("DETACH DATABASE other")
+        return number_copied
+
+    def completed_series(self) -> dict[tuple[str, str], str]:
+        """ (alias_dir, eye) -> fingerprint of the series stored in full """
+        cursor = self.connection.execute(f"SELECT alias_dir, eye, fingerprint FROM {self.completed_series_table}")
+        return {(row["alias_dir"], row["eye"]): row["fingerprint"] for row in cursor}
+
+    def _pack(self, ppd: PosteriorPoleData, map_name: str) -> bytes | None:
+        # a map still in compact form is not decoded if it is already in the store's codec
+        value = ppd.__dict__.get(f"_{map_name}")
+        if not isinstance(value, CompactMap): value = ppd.map_array(map_name)
+        return pack_map(value, self.codec, MAP_SCALES[map_name])
+
+    def upsert_progression(self, progression: ProgressionMaps) -> int:
+        """ Store the progression maps, replacing the earlier ones of the same scans; drops those of scans no longer stored. """
+        # float32 with any compact codec: "i2" could not hold them, "auto" would never pick it
+        codec = "f8" if self.codec == "f8" else PROGRESSION_CODEC
+
+        def pack_progression(values: np.ndarray) -> bytes | None:
+            return None if np.isnan(values).all() else pack_map(values, codec)
+
+        rows = [(file_md5, progression.previous_md5s[i], progression.baseline_md5s[i],
+                 None if np.isnan(progression.years_since_previous[i]) else float(progression.years_since_previous[i]),
+                 float(progression.years_since_baseline[i]),
+                 *[pack_progression(getattr(progression, map_name)[i]) for map_name in PROGRESSION_MAPS])
+                for i, file_md5 in enumerate(progression.file_md5s)]
+        with self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO {self.progression_table} "
+                                        f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute(f"DELETE FROM {self.progression_table} "
+                                    f"WHERE file_md5 NOT IN (SELECT file_md5 FROM {self.pp_table})")
+        return len(rows)
+
+    def upsert_scores(self, ppds: Iterable[PosteriorPoleData]) -> int:
+        ppds = self._assign_patient_ids(ppds)
+        rows = [(ppd.filename_md5, ppd.patient_id, ppd.alias, ppd.laterality, ppd.age_at_test, ppd.filename,
+                 ppd.avg_thickness, ppd.wtd_avg_thickness) for ppd in ppds]
+        with self.connection:
+            self.connection.executemany(f"""
+                INSERT INTO {self.scores_table} (file_md5, patient_id, alias, eye, age_acquired, file_name,
+                                                 avg_thickness, wtd_avg_thickness)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(file_md5) DO UPDATE SET
+                    patient_id=excluded.patient_id, alias=excluded.alias, eye=excluded.eye, age_acquired=excluded.age_acquired,
+                    file_name=excluded.file_name, avg_thickness=excluded.avg_thickness,
+                    wtd_avg_thickness=excluded.wtd_avg_thickness
+                """, rows)
+        return len(rows)
+
+    ###########################
+    def _where(self, alias: str | None = None, eye: str | None = None, age_range: tuple[float, float] | None = None,
+               file_md5: str | None = None, patient_id: int | None = None) -> tuple[str, list]:
+        conditions = []
+        params = []
+        if alias is not None:
+            # an alias not in the store matches nothing
+            conditions.append("patient_id = ?")
+            params.append(self.identity.get(alias))
+        if patient_id is not None:
+            conditions.append("patient_id = ?")
+            params.append(patient_id)
+        if eye is not None:
+            conditions.append("eye = ?")
+            params.append(eye)
+        if age_range is not None:
+            conditions.append("age_acquired BETWEEN ? AND ?")
+            params.extend(age_range)
+        if file_md5 is not None:
+            conditions.append("file_md5 = ?")
+            params.append(file_md5)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return where, params
+
+    @staticmethod
+    def row_to_ppd(row: sqlite3.Row) -> PosteriorPoleData:
+        ppd = PosteriorPoleData(alias=row["alias"], laterality=row["eye"], age_at_test=row["age_acquired"])
+        ppd.patient_id = row["patient_id"]
+        ppd.filename = row["file_name"]
+        ppd.filename_md5 = row["file_md5"]
+        ppd.total_volume = row["total_volume"]
+        ppd.choroid_ok = bool(row["choroid_ok"])
+        # the maps are decoded only if and when they are used
+        ppd.pp_map = blob_to_map(row["pp_map"], MAP_SCALES["pp_map"])
+        ppd.weights = blob_to_map(row["weights"], MAP_SCALES["weights"])
+        ppd.interpolated_map = blob_to_map(row["interpolated_map"], MAP_SCALES["interpolated_map"])
+        return ppd
+
+    def query_ppds(self, alias: str | None = None, eye: str | None = None,
+                   age_range: tuple[float, float] | None = None, file_md5: str | None = None,
+                   patient_id: int | None = None) -> list[PosteriorPoleData]:
+        """ Fetch the matching scans, sorted by patient, eye and age. All filters are optional. """
+        where, params = self._where(alias, eye, age_range, file_md5, patient_id)
+        cursor = self.connection.execute(f"SELECT * FROM {self.pp_table} {where} "
+                                         f"ORDER BY patient_id, eye, age_acquired", params)
+        return [self.row_to_ppd(row) for row in cursor]
+
+    def query_scores(self, alias: str | None = None, eye: str | None = None,
+                     age_range: tuple[float, float] | None = None, patient_id: int | None = None) -> pd.DataFrame:
+        where, params = self._where(alias, eye, age_range, patient_id=patient_id)
+        cursor = self.connection.execute(f"SELECT * FROM {self.scores_table} {where} "
+                                         f"ORDER BY patient_id, eye, age_acquired", params)
+        rows = cursor.fetchall()
+        columns = [d[0] for d in cursor.description]
+        import pandas as pd
+        return pd.DataFrame([tuple(row) for row in rows], columns=columns)
+
+    @staticmethod
+    def row_to_grid(row: sqlite3.Row) -> ThicknessGrid:
+        shape = (row["n_rows"],) if row["n_cols"] is None else (row["n_rows"], row["n_cols"])
+        values = {value_name: CompactMap.from_bytes(row[value_name], shape, GRID_SCALES[value_name]).to_array()
+                  for value_name in GRID_VALUES}
+        return ThicknessGrid(row["grid_name"], json.loads(row["zone_names"]), total_volume=row["total_volume"], **values)
+
+    def query_grids(self, grid_name: str | None = None, alias: str | None = None, eye: str | None = None,
+                    age_range: tuple[float, float] | None = None, file_md5: str | None = None,
+                    patient_id: int | None = None) -> dict[str, dict[str, ThicknessGrid]]:
+        """ file_md5 -> {grid name -> grid} of the matching scans (as in query_ppds), optionally of one grid only. """
+        where, params = self._where(alias, eye, age_range, file_md5, patient_id)
+        if grid_name is not None:
+            where = f"{where} AND grid_name = ?" if where else "WHERE grid_name = ?"
+            params.append(grid_name)
+        cursor = self.connection.execute(f"SELECT g.* FROM {self.grids_table} g JOIN {self.pp_table} USING (file_md5) "
+                                         f"{where} ORDER BY patient_id, eye, age_acquired", params)
+        grids = {}
+        for row in cursor:
+            grids.setdefault(row["file_md5"], {})[row["grid_name"]] = self.row_to_grid(row)
+        return grids
+
+    def load_grids(self, ppds: Iterable[PosteriorPoleData]) -> list[PosteriorPoleData]:
+        """ Fill in the thickness_grids of scans returned by query_ppds (which does not load them). """
+        ppds = list(ppds)
+        md5s = [ppd.filename_md5 for ppd in ppds]
+        grids = {}
+        for start in range(0, len(md5s), 500):  # within the SQLite limit on the number of parameters
+            chunk = md5s[start:start + 500]
+            cursor = self.connection.execute(f"SELECT * FROM {self.grids_table} "
+                                             f"WHERE file_md5 IN ({', '.join('?' * len(chunk))})", chunk)
+            for row in cursor:
+                grids.setdefault(row["file_md5"], {})[row["grid_name"]] = self.row_to_grid(row)
+        for ppd in ppds:
+            ppd.thickness_grids = grids.get(ppd.filename_md5, {})
+        return ppds
+
+    def query_progression(self, alias: str | None = None, eye: str | None = None,
+                          age_range: tuple[float, float] | None = None, file_md5: str | None = None,
+                          patient_id: int | None = None) -> ProgressionMaps:
+        """ The progression maps of the matching scans, in the same order as query_ppds returns the scans. """
+        where, params = self._where(alias, eye, age_range, file_md5, patient_id)
+        rows = self.connection.execute(f"SELECT g.* FROM {self.progression_table} g JOIN {self.pp_table} "
+                                       f"USING (file_md5) {where} ORDER BY patient_id, eye, age_acquired", params).fetchall()
+        maps = {map_name: np.full((len(rows), *MAP_SHAPE), np.nan) for map_name in PROGRESSION_MAPS}
+        for i, row in enumerate(rows):
+            for map_name in PROGRESSION_MAPS:
+                if row[map_name] is not None:
+                    maps[map_name][i] = CompactMap.from_bytes(row[map_name], MAP_SHAPE).to_array()
+        return ProgressionMaps([row["file_md5"] for row in rows], [row["previous_md5"] for row in rows],
+                               [row["baseline_md5"] for row in rows],
+                               np.array([np.nan if row["years_since_previous"] is None else row["years_since_previous"]
+                                         for row in rows], dtype=float),
+                               np.array([row["years_since_baseline"] for row in rows], dtype=float), **maps)
+
+    def file_md5s(self) -> list[str]:
+        cursor = self.connection.execute(f"SELECT file_md5 FROM {self.pp_table} ORDER BY file_md5")
+        return [row[0] for row in cursor]
+
+    def aliases(self) -> list[str]:
+        cursor = self.connection.execute(f"SELECT alias FROM {self.patients_table} ORDER BY alias")
+        return [row[0] for row in cursor]
+
+    def count(self) -> int:
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.pp_table}").fetchone()[0]
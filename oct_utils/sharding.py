@@ -0,0 +1,193 @@
+"""
+Splitting a cohort over several machines (or local processes).
+
+The aliases are assigned to shards by a stable hash of their canonical form, so every
+node computes the same partition without talking to the others. The shards are the
+work items of a queue kept in an SQLite file on the shared filesystem: a worker claims
+an item for a limited time (the lease), keeps renewing the lease while it works on it,
+and marks it done at the end. The items of a worker that died are claimed again by
+another worker once their lease has expired. A worker that finds it has lost the lease
+(e.g. after a long stall) stops and discards its result: the item is someone else's now.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from oct_utils.conventions import normalize_alias
+
+WORK_QUEUE_TABLE_NAME = "work_items"
+DEFAULT_LEASE_SECONDS = 600.0
+MAX_ATTEMPTS = 3
+
+# work item statuses
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+
+def shard_of(alias: str, n_shards: int) -> int:
+    """ The shard of the alias; the same on every machine and in every run (unlike hash()). """
+    digest = hashlib.sha1(normalize_alias(alias).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+
+def shard_item(data_group: str, shard: int) -> str:
+    return f"{data_group}:{shard}"
+
+
+def parse_shard_item(item: str) -> tuple[str, int]:
+    (data_group, shard) = item.rsplit(":", 1)
+    return data_group, int(shard)
+
+
+class WorkQueue:
+    """
+    Usage:
+        queue = WorkQueue(f"{scratch_dir}/shards/work_queue.sqlite")
+        queue.add(["patients:0", "patients:1"])
+        while (item := queue.claim(worker_name)) is not None:
+            with queue.keep_alive(item, worker_name) as lease:
+                ...  # process the item, calling lease.check() before each step that writes
+            if not queue.complete(item, worker_name):
+                ...  # the lease was lost: the result is discarded
+    """
+    table_name: str = WORK_QUEUE_TABLE_NAME
+
+    def __init__(self, db_path: str, lease_seconds: float = DEFAULT_LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as connection:
+            connection.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    item          TEXT PRIMARY KEY,
+                    status        TEXT NOT NULL,
+                    worker        TEXT,
+                    lease_expires REAL,
+                    attempts      INTEGER NOT NULL DEFAULT 0,
+                    error         TEXT
+                )""")
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection per operation: the queue is used from several processes, and from the keep-alive thread
+        connection = sqlite3.connect(self.db_path, timeout=60.0, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def add(self, items: list[str]) -> int:
+        """ Add the items not in the queue yet; returns the number added. """
+        with self._connect() as connection:
+            before = connection.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+            connection.executemany(f"INSERT OR IGNORE INTO {self.table_name} (item, status) VALUES (?, ?)",
+                                   [(item, PENDING) for item in items])
+            return connection.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0] - before
+
+    def claim(self, worker: str) -> str | None:
+        """
+        A pending item, or one whose lease has expired; None if there is nothing left to claim.
+        An expired item that has already had max_attempts is given up on (FAILED) instead:
+        a shard that keeps killing its workers would otherwise be handed out forever.
+        """
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")  # one claimer at a time
+            now = time.time()
+            connection.execute(f"""
+                UPDATE {self.table_name} SET status = ?, lease_expires = NULL,
+                                             error = 'lease expired after ' || attempts || ' attempts'
+                WHERE status = ? AND lease_expires < ? AND attempts >= ?""",
+                (FAILED, CLAIMED, now, self.max_attempts))
+            row = connection.execute(f"""
+                SELECT item FROM {self.table_name}
+                WHERE status = ? OR (status = ? AND lease_expires < ?)
+                ORDER BY attempts, item LIMIT 1""", (PENDING, CLAIMED, now)).fetchone()
+            if row is not None:
+                connection.execute(f"""
+                    UPDATE {self.table_name} SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1
+                    WHERE item = ?""", (CLAIMED, worker, now + self.lease_seconds, row["item"]))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return None if row is None else row["item"]
+
+    def renew(self, item: str, worker: str) -> bool:
+        """ Extend the lease; False if the item is no longer this worker's. """
+        with self._connect() as connection:
+            cursor = connection.execute(f"""
+                UPDATE {self.table_name} SET lease_expires = ?
+                WHERE item = ? AND worker = ? AND status = ?""", (time.time() + self.lease_seconds, item, worker, CLAIMED))
+            return cursor.rowcount == 1
+
+    def complete(self, item: str, worker: str) -> bool:
+        """ Mark the item done; False if the item is no longer this worker's (nothing is changed then). """
+        with self._connect() as connection:
+            cursor = connection.execute(f"""
+                UPDATE {self.table_name} SET status = ?, lease_expires = NULL, error = NULL
+                WHERE item = ? AND worker = ? AND status = ?""", (DONE, item, worker, CLAIMED))
+            return cursor.rowcount == 1
+
+    def fail(self, item: str, worker: str, error: str):
+        """ Put the item back in the queue, or give up on it after max_attempts. """
+        with self._connect() as connection:
+            connection.execute(f"""
+                UPDATE {self.table_name} SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                                             lease_expires = NULL, error = ?
+                WHERE item = ? AND worker = ? AND status = ?""",
+                (self.max_attempts, FAILED, PENDING, error, item, worker, CLAIMED))
+
+    def keep_alive(self, item: str, worker: str) -> "LeaseKeeper":
+        return LeaseKeeper(self, item, worker)
+
+    def statuses(self) -> dict[str, str]:
+        with self._connect() as connection:
+            return {row["item"]: row["status"] for row in connection.execute(f"SELECT item, status FROM {self.table_name}")}
+
+    def errors(self) -> dict[str, str]:
+        with self._connect() as connection:
+            return {row["item"]: row["error"] for row in
+                    connection.execute(f"SELECT item, error FROM {self.table_name} WHERE error IS NOT NULL")}
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaseKeeper:
+    """
+    Renews the lease of an item from a background thread, for as long as the with block runs.
+    Once a renewal fails, the lease is lost for good: check() raises LeaseLost.
+    """
+
+    def __init__(self, queue: WorkQueue, item: str, worker: str):
+        self.queue = queue
+        self.item = item
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(self.item, self.worker):
+                print(f"Warning: {self.worker} lost the lease on {self.item}")
+                self.lost.set()
+                return
+
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseLost(f"{self.worker} lost the lease on {self.item}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+def default_worker_name() -> str:
+    return f"{os.uname().nodename}:{os.getpid()}"
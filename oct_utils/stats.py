@@ -1,56 +1,113 @@
+import json
+import os
+
 import numpy as np
-import pandas as pd
 
 from oct_utils.data_structures import PosteriorPoleData
 
+WEIGHT_TYPES = ["8x8", "4x4", "2x2", "concentric", "optimized", "physiological"]
 
-def weighted_avg(ppd: PosteriorPoleData, interp=False, weight_type="") -> float:
+OPTIMIZED_WEIGHTS = np.array([
+    [5.0, 20.0, 5.0, 5.0, 5.0, 5.0, 5.0, 5.0],
+    [5.0, 70.0, 5.0, 5.0, 5.0, 5.0, 5.0, 5.0],
+    [10.0, 65.0, 5.0, 5.0, 15.0, 5.0, 5.0, 5.0],
+    [90.0, 10.0, 5.0, 155.0, 250.0, 5.0, 5.0, 5.0],
+    [5.0, 5.0, 5.0, 65.0, 80.0, 5.0, 5.0, 5.0],
+    [5.0, 45.0, 5.0, 5.0, 5.0, 25.0, 5.0, 5.0],
+    [5.0, 70.0, 80.0, 15.0, 5.0, 5.0, 5.0, 5.0],
+    [5.0, 5.0, 5.0, 45.0, 130.0, 130.0, 85.0, 110.0]
+])
 
-    if interp:
-        df = ppd.interpolated_map
-        weights = pd.DataFrame(np.full((8, 8), 100, dtype=float))
-    else:
-        df = ppd.pp_map
-        weights = ppd.weights
+PHYSIOLOGICAL_WEIGHTS = np.array([
+    [43, 53, 56, 55, 55, 56, 53, 43], [35, 55, 48, 29, 29, 48, 33, 9], [30, 5, 2, 2, 2, 3, 2, 3], [25, 2, 2, 2, 2, 2, 2, 5], [25, 2, 2, 2, 2, 2, 2, 5], [30, 5, 2, 2, 2, 28, 2, 3], [35, 99, 89, 61, 61, 89, 99, 16], [56, 88, 100, 99, 99, 99, 88, 56]
+], dtype=float)
+
+# written by 07_pr_desnity_to_weights from the photoreceptor densities (a pipeline stage, which rewrites it
+# whenever the densities change); PHYSIOLOGICAL_WEIGHTS are used if there is no such file
+PHYSIOLOGICAL_WEIGHTS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                          "data", "physiological_weights.json")
+# written only by 07_pr_desnity_to_weights --sweep --write-best: the pick of the sweep, used instead of
+# the weights above as long as it is there (delete it to go back to them)
+SELECTED_WEIGHTS_PATH = os.path.join(os.path.dirname(PHYSIOLOGICAL_WEIGHTS_PATH), "selected_weights.json")
+_physiological_weights_cache = {}
+
+
+def physiological_weights(path: str | None = None) -> np.ndarray:
+    """
+    The weights in the json file, read again only when the file changes; PHYSIOLOGICAL_WEIGHTS if there is none.
+    By default, the file is SELECTED_WEIGHTS_PATH if there is one, and PHYSIOLOGICAL_WEIGHTS_PATH otherwise.
+    """
+    for path in [path] if path else [SELECTED_WEIGHTS_PATH, PHYSIOLOGICAL_WEIGHTS_PATH]:
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        if _physiological_weights_cache.get(path, (None,))[0] != modified:
+            with open(path) as inf:
+                weights = np.array(json.load(inf)["weights"], dtype=float)
+            if weights.shape != PHYSIOLOGICAL_WEIGHTS.shape:
+                raise ValueError(f"{path}: the weights should be {PHYSIOLOGICAL_WEIGHTS.shape}, not {weights.shape}")
+            _physiological_weights_cache[path] = (modified, weights)
+        return _physiological_weights_cache[path][1]
+    return PHYSIOLOGICAL_WEIGHTS
+
+
+def scheme_weights(weight_type: str, valid_pct: np.ndarray | None = None) -> np.ndarray:
+    """
+    Weights of the scheme, for a single map (8, 8) or a stack of them (N, 8, 8).
+    The cells outside of the scheme's region get weight 0. The valid pixel percentages
+    are used where the scheme does not prescribe weights of its own (8x8, 4x4 and 2x2);
+    if not given, all cells count the same.
+    """
+    base = np.full((8, 8), 100.0) if valid_pct is None else np.asarray(valid_pct, dtype=float)
 
     if weight_type == "8x8":
-        pass  # that's the default
+        weights = base.copy()  # that's the default
     elif weight_type == "4x4":
         # the numbers here came about as follows - the xml file from spectralis
         # claims that in the 8x8 grid the dims of ecah are 0.86 x 0.86 mm
         # while the outer diameter is 3.45 mm in the bullseye grid
         # 3.45/0.86 = 4.01, thus the inner 4x4 covers it with a bit of extra on the sides
-        df = df.iloc[2:6, 2:6]
-        weights = weights.iloc[2:6, 2:6]
+        weights = np.zeros_like(base)
+        weights[..., 2:6, 2:6] = base[..., 2:6, 2:6]
 
     elif weight_type == "2x2":
-        df = df.iloc[3:5, 3:5]
-        weights = weights.iloc[3:5, 3:5]
+        weights = np.zeros_like(base)
+        weights[..., 3:5, 3:5] = base[..., 3:5, 3:5]
 
     elif weight_type == "concentric":
         # downweight the outer rings
         # for s, w in [(0, 5), (1, 10), (2, 50), (3, 100)]:
+        weights = np.empty_like(base)
         for s, w in [(0, 5), (1, 25), (2, 50), (3, 100)]:
-            weights.iloc[s:8-s, s:8-s] = w
+            weights[..., s:8-s, s:8-s] = w
 
     elif weight_type == "optimized":
-        weights = pd.DataFrame([
-            [5.0, 20.0, 5.0, 5.0, 5.0, 5.0, 5.0, 5.0],
-            [5.0, 70.0, 5.0, 5.0, 5.0, 5.0, 5.0, 5.0],
-            [10.0, 65.0, 5.0, 5.0, 15.0, 5.0, 5.0, 5.0],
-            [90.0, 10.0, 5.0, 155.0, 250.0, 5.0, 5.0, 5.0],
-            [5.0, 5.0, 5.0, 65.0, 80.0, 5.0, 5.0, 5.0],
-            [5.0, 45.0, 5.0, 5.0, 5.0, 25.0, 5.0, 5.0],
-            [5.0, 70.0, 80.0, 15.0, 5.0, 5.0, 5.0, 5.0],
-            [5.0, 5.0, 5.0, 45.0, 130.0, 130.0, 85.0, 110.0]
-        ])
+        weights = np.broadcast_to(OPTIMIZED_WEIGHTS, base.shape).copy()
     elif weight_type == "physiological":
-        weights = pd.DataFrame([
-            [43, 53, 56, 55, 55, 56, 53, 43], [35, 55, 48, 29, 29, 48, 33, 9], [30, 5, 2, 2, 2, 3, 2, 3], [25, 2, 2, 2, 2, 2, 2, 5], [25, 2, 2, 2, 2, 2, 2, 5], [30, 5, 2, 2, 2, 28, 2, 3], [35, 99, 89, 61, 61, 89, 99, 16], [56, 88, 100, 99, 99, 99, 88, 56]
-            ])
+        weights = np.broadcast_to(physiological_weights(), base.shape).copy()
     else:
         raise Exception(f"Unrecognized wighting scheme: {weight_type}")
 
-    sum_of_weights = weights[df.notna()].sum().sum()
-    wavg = (df*weights).sum().sum()/sum_of_weights
+    return weights
+
+
+def weighted_avg_stack(maps: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """ Weighted average over the last two axes, skipping the NaN cells (and their weights). """
+    valid = ~np.isnan(maps)
+    sum_of_weights = np.where(valid, weights, 0.0).sum(axis=(-2, -1))
+    return np.where(valid, maps * weights, 0.0).sum(axis=(-2, -1)) / sum_of_weights
+
+
+def weighted_avg(ppd: PosteriorPoleData, interp=False, weight_type="") -> float:
+
+    if interp:
+        thck_map = ppd.map_array("interpolated_map")
+        valid_pct = None
+    else:
+        thck_map = ppd.map_array("pp_map")
+        valid_pct = ppd.map_array("weights")
+
+    weights = scheme_weights(weight_type, valid_pct)
+    wavg = weighted_avg_stack(thck_map, weights)
     return float(wavg) # otherwise we get tthe np.float
@@ -0,0 +1,109 @@
+"""
+All the thickness grids of an xml export, as parsed in the same pass as the posterior pole map.
+
+Spectralis exports several ThicknessGrid elements per scan (e.g. "ETDRS" and
+"8x8 Posterior Pole Grid"), each a list of zones with their average thickness,
+volume and valid pixel percentage. A grid whose zones are all named "row,col"
+(1-based) is held as 2D arrays (n_rows, n_cols); any other grid (e.g. the ETDRS
+zones C0, S1, N1, ...) as 1D arrays, in the order of the zones in the file.
+Missing values are NaN.
+"""
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+THICKNESS_GRIDS_TABLE_NAME = "thickness_grids"
+POSTERIOR_POLE_GRID_NAME = "8x8 Posterior Pole Grid"
+ZONE_ROW_COL = re.compile(r"^\s*(\d+)\s*,\s*(\d+)\s*$")
+# i2 units per unit of the grid values (see oct_utils.compact_maps): thickness in mm, volume in mm^3, percent
+GRID_SCALES = {"thickness": 1000.0, "volume": 1000.0, "valid_pct": 100.0}
+GRID_VALUES = list(GRID_SCALES)
+
+
+def _float_or_nan(element: ET.Element | None) -> float:
+    if element is None or element.text is None or not element.text.strip(): return np.nan
+    try:
+        return float(element.text)
+    except ValueError:
+        return np.nan
+
+
+class ThicknessGrid:
+    """
+    Usage:
+        grids = parse_thickness_grids(tree)
+        etdrs = grids["ETDRS"]
+        etdrs.zone("C0")        # {"thickness": ..., "volume": ..., "valid_pct": ...}
+        grids[POSTERIOR_POLE_GRID_NAME].thickness   # (8, 8)
+    """
+
+    def __init__(self, name: str, zone_names: list[str], thickness: np.ndarray, volume: np.ndarray,
+                 valid_pct: np.ndarray, total_volume: float | None = None):
+        self.name = name
+        self.zone_names = zone_names
+        self.thickness = thickness
+        self.volume = volume
+        self.valid_pct = valid_pct
+        self.total_volume = total_volume
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.thickness.shape
+
+    @property
+    def is_2d(self) -> bool:
+        return self.thickness.ndim == 2
+
+    def zone_index(self, zone_name: str) -> tuple[int, ...]:
+        """ Position of the zone in the value arrays. """
+        match = ZONE_ROW_COL.match(zone_name)
+        if self.is_2d and match: return int(match.group(1)) - 1, int(match.group(2)) - 1
+        if zone_name not in self.zone_names:
+            raise ValueError(f"No zone {zone_name} in the grid {self.name}")
+        return (self.zone_names.index(zone_name),)
+
+    def zone(self, zone_name: str) -> dict[str, float]:
+        index = self.zone_index(zone_name)
+        return {value_name: float(getattr(self, value_name)[index]) for value_name in GRID_VALUES}
+
+    @classmethod
+    def from_element(cls, grid: ET.Element) -> "ThicknessGrid | None":
+        """ The grid of a ThicknessGrid element; None if it has no name or no zones. """
+        name = grid.findtext("Name")
+        zones = grid.findall("./Zone")
+        if name is None or not zones: return None
+        zone_names = [(zone.findtext("Name") or "").strip() for zone in zones]
+        values = np.array([[_float_or_nan(zone.find(tag)) for tag in ["AvgThickness", "Volume", "ValidPixelPercentage"]]
+                           for zone in zones])
+        total_volume = _float_or_nan(grid.find("TotalVolume"))
+        total_volume = None if np.isnan(total_volume) else total_volume
+
+        matches = [ZONE_ROW_COL.match(zone_name) for zone_name in zone_names]
+        if not all(matches):
+            return cls(name.strip(), zone_names, values[:, 0], values[:, 1], values[:, 2], total_volume)
+
+        # "row,col" zones: laid out on a 2D grid, large enough for all of them
+        rows = np.array([int(match.group(1)) - 1 for match in matches])
+        cols = np.array([int(match.group(2)) - 1 for match in matches])
+        if np.any(rows < 0) or np.any(cols < 0): return None
+        shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+        arrays = []
+        for i in range(3):
+            array = np.full(shape, np.nan)
+            array[rows, cols] = values[:, i]
+            arrays.append(array)
+        grid_zone_names = [f"{row + 1},{col + 1}" for row in range(shape[0]) for col in range(shape[1])]
+        return cls(name.strip(), grid_zone_names, *arrays, total_volume)
+
+    def __str__(self):
+        return f"{self.name} {'x'.join(map(str, self.shape))}, total volume {self.total_volume}"
+
+
+def parse_thickness_grids(tree: ET.ElementTree) -> dict[str, ThicknessGrid]:
+    """ grid name -> ThicknessGrid, for every grid with zones in the export """
+    grids = {}
+    for element in tree.findall(".//ThicknessGrid"):
+        grid = ThicknessGrid.from_element(element)
+        if grid is not None: grids[grid.name] = grid
+    return grids
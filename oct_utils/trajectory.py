@@ -0,0 +1,162 @@
+"""
+Longitudinal thickness trajectories, fitted against age across the whole cohort.
+
+For every series s (an alias/eye pair), scan i and cell (or score) k, two linear models are fitted:
+
+    per series:     y_sik = a_sk + b_sk * t_si
+    cohort:         y_sik = a_sk + b_k  * t_si      (series-specific intercepts, common slope)
+
+The cohort slope is the within-series (fixed effects) estimator, i.e. the mean rate of change
+once the differences in the baseline thickness between patients have been taken out.
+
+Only the per-series sufficient statistics (n, sum t, sum t^2, sum y, sum t*y) are kept,
+so adding new visits updates the sums and refits without touching the earlier scans,
+and all cells of all series are solved together in one batched call to np.linalg.solve.
+"""
+import warnings
+from collections.abc import Hashable, Sequence
+
+import numpy as np
+
+# series whose ages are (nearly) all the same have no slope to speak of
+MIN_AGE_SPREAD = 1.e-6
+
+
+class TrajectoryModel:
+    """
+    Usage:
+        model = TrajectoryModel().fit(ages, maps, series_labels)      # maps of shape (N, 8, 8), or scores (N,)
+        model.partial_fit(new_ages, new_maps, new_labels)              # refit with additional visits
+        model.cohort_slope                                             # (8, 8): change per year
+        model.slopes                                                   # (number of series, 8, 8)
+    """
+
+    def __init__(self):
+        self.value_shape: tuple | None = None
+        self.series: list[Hashable] = []
+        self.series_index: dict[Hashable, int] = {}
+        self._reset_sums(0)
+
+    def _reset_sums(self, n_values: int):
+        # shape (number of series, number of values): the sums run over the valid (non-NaN)
+        # values only, and the NaNs differ from cell to cell
+        self.n = np.zeros((0, n_values))
+        self.sum_t = np.zeros((0, n_values))
+        self.sum_tt = np.zeros((0, n_values))
+        self.sum_y = np.zeros((0, n_values))
+        self.sum_ty = np.zeros((0, n_values))
+
+    def _grow(self, labels: Sequence[Hashable]) -> np.ndarray:
+        """ Register new series; return the index of the series of each scan. """
+        new_series = [label for label in dict.fromkeys(labels) if label not in self.series_index]
+        for label in new_series:
+            self.series_index[label] = len(self.series)
+            self.series.append(label)
+        if new_series:
+            padding = np.zeros((len(new_series), self.n.shape[1]))
+            for attr in ["n", "sum_t", "sum_tt", "sum_y", "sum_ty"]:
+                setattr(self, attr, np.concatenate([getattr(self, attr), padding]))
+        return np.array([self.series_index[label] for label in labels], dtype=int)
+
+    ###########################
+    def fit(self, ages, values, labels: Sequence[Hashable]) -> "TrajectoryModel":
+        self.__init__()
+        return self.partial_fit(ages, values, labels)
+
+    def partial_fit(self, ages, values, labels: Sequence[Hashable]) -> "TrajectoryModel":
+        """ Add scans (possibly of new series) to the model and refit. """
+        ages = np.asarray(ages, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if not (len(ages) == len(values) == len(labels)):
+            raise ValueError("ages, values and labels must have the same length")
+        if self.value_shape is None:
+            self.value_shape = values.shape[1:]
+            self._reset_sums(int(np.prod(self.value_shape, dtype=int)))
+        elif values.shape[1:] != self.value_shape:
+            raise ValueError(f"expected values of shape (N, {self.value_shape}), got {values.shape}")
+
+        idx = self._grow(labels)
+        flat = values.reshape(len(values), -1)
+        valid = ~np.isnan(flat)
+        y = np.where(valid, flat, 0.0)
+        t = ages[:, None]
+
+        np.add.at(self.n, idx, valid)
+        np.add.at(self.sum_t, idx, valid * t)
+        np.add.at(self.sum_tt, idx, valid * t ** 2)
+        np.add.at(self.sum_y, idx, y)
+        np.add.at(self.sum_ty, idx, y * t)
+
+        self._solve()
+        return self
+
+    def _solve(self):
+        n, st, stt = self.n, self.sum_t, self.sum_tt
+        sy, sty = self.sum_y, self.sum_ty
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sxx = stt - st ** 2 / n
+            sxy = sty - st * sy / n
+        fittable = (n >= 2) & (sxx > MIN_AGE_SPREAD)
+
+        # per series: 2x2 normal equations for every series and value, solved in one batched call
+        (n_series, n_values) = n.shape
+        xtx = np.empty((n_series, n_values, 2, 2))
+        xtx[..., 0, 0] = n
+        xtx[..., 0, 1] = xtx[..., 1, 0] = st
+        xtx[..., 1, 1] = stt
+        xty = np.stack([sy, sty], axis=-1)[..., None]
+        # make the unfittable systems harmless, and blank their results afterwards
+        xtx[~fittable] = np.eye(2)
+        xty[~fittable] = 0.0
+        solution = np.linalg.solve(xtx, xty)[..., 0]
+        solution[~fittable] = np.nan
+        self._intercepts = solution[..., 0]
+        self._slopes = solution[..., 1]
+
+        # cohort: within-series estimate of the common slope, from the series with any spread in age
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._cohort_slope = (np.where(fittable, sxy, 0.0).sum(axis=0)
+                                  / np.where(fittable, sxx, 0.0).sum(axis=0))
+            self._cohort_intercepts = (sy - self._cohort_slope * st) / n
+
+    ###########################
+    def _reshape(self, array: np.ndarray) -> np.ndarray:
+        return array.reshape(array.shape[:-1] + self.value_shape)
+
+    @property
+    def slopes(self) -> np.ndarray:
+        """ Per-series rate of change per year; NaN for series with fewer than two visits. """
+        return self._reshape(self._slopes)
+
+    @property
+    def intercepts(self) -> np.ndarray:
+        return self._reshape(self._intercepts)
+
+    @property
+    def cohort_slope(self) -> np.ndarray:
+        return self._reshape(self._cohort_slope)
+
+    @property
+    def cohort_intercepts(self) -> np.ndarray:
+        return self._reshape(self._cohort_intercepts)
+
+    def slope_summary(self) -> tuple[np.ndarray, np.ndarray]:
+        """ Mean and standard error of the per-series slopes across the cohort. """
+        counts = np.sum(~np.isnan(self._slopes), axis=0)
+        with warnings.catch_warnings():
+            # cells without any fitted series are expected to come out as NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean = np.nanmean(self._slopes, axis=0)
+            sd = np.nanstd(self._slopes, axis=0, ddof=1)
+        sem = np.where(counts > 1, sd / np.sqrt(np.maximum(counts, 1)), np.nan)
+        return self._reshape(mean), self._reshape(sem)
+
+    def predict(self, ages, labels: Sequence[Hashable], cohort: bool = True) -> np.ndarray:
+        """ Fitted values at the given ages for the given (already fitted) series. """
+        ages = np.asarray(ages, dtype=float)
+        idx = np.array([self.series_index[label] for label in labels], dtype=int)
+        if cohort:
+            fitted = self._cohort_intercepts[idx] + self._cohort_slope[None, :] * ages[:, None]
+        else:
+            fitted = self._intercepts[idx] + self._slopes[idx] * ages[:, None]
+        return self._reshape(fitted)
@@ -0,0 +1,65 @@
+"""
+Deferred md5 verification of the source xml files.
+
+Instead of hashing each file before its row can be used, the checks are queued and
+run in the background by a small thread pool (hashlib releases the GIL while hashing),
+and the mismatches are reported together when the batch is collected. The outputs
+made from a file that fails its check are deleted before the mismatch is reported,
+so that no valid-looking figure or table of a corrupted file is left behind.
+"""
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from oct_utils.data_structures import PosteriorPoleData, file_md5
+
+
+class DeferredMd5Check:
+    """
+    Usage:
+        with DeferredMd5Check() as md5_check:
+            for ppd in ppds:
+                md5_check.submit(ppd, xml_dir_path, outputs=[figure_path])
+                ...  # work with ppd (write figure_path) while the file is being hashed
+        # leaving the block waits for all checks, deletes the outputs of the failed ones,
+        # and raises ValueError on any mismatch
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending: list[tuple[str, str, list[str], Future]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            # if the block failed on its own, do not mask its exception with md5 problems
+            if exc_type is None: self.wait()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, ppd: PosteriorPoleData, xml_dir_path: str | None, outputs: list[str] | None = None):
+        """ outputs: the files to be made from this scan, deleted if its check fails """
+        path = ppd.source_path(xml_dir_path)
+        self.pending.append((path, ppd.filename_md5, outputs or [], self.executor.submit(file_md5, path)))
+
+    def mismatches(self) -> list[str]:
+        """ Waits for all queued checks; returns the description of each failed one, and deletes its outputs. """
+        failed = []
+        for path, expected_md5, outputs, future in self.pending:
+            try:
+                calculated_md5 = future.result()
+            except OSError as e:
+                failed.append(f"{path}: {e}")
+            else:
+                if calculated_md5 == expected_md5: continue
+                failed.append(f"MD5 mismatch for {path}: expected {expected_md5}, got {calculated_md5}")
+            for output in outputs:
+                if os.path.exists(output): os.remove(output)
+        self.pending = []
+        return failed
+
+    def wait(self):
+        failed = self.mismatches()
+        if failed:
+            raise ValueError("\n".join(failed))
@@ -1,5 +1,4 @@
 import numpy as np
-from matplotlib import pyplot as plt
 
 
 def plot_results(grid_values, extent, cell_size_mm, output_file='', label='Measurement Value'):
@@ -17,6 +16,8 @@ def plot_results(grid_values, extent, cell_size_mm, output_file='', label='Measu
     output_file : str
         Filename for saving the plot
     """
+    from matplotlib import pyplot as plt
+
     plt.figure(figsize=(10, 8))
 
     # Plot heatmap
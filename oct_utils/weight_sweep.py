@@ -0,0 +1,124 @@
+"""
+Sweep over the photoreceptor-derived weight maps, scored against a stored cohort.
+
+A candidate weight map is made the way 07_pr_desnity_to_weights makes the physiological one:
+each density map is normalized, the two are mixed with the rod fraction f,
+
+    w = f * norm(rods) + (1 - f) * norm(cones)
+
+and w is rescaled linearly to the range [low, high]. All candidates of the grid
+(normalizations x rod fractions x ranges) are built in one broadcasted computation,
+and the whole cohort is scored with all of them in one matrix product.
+
+Each candidate is judged by
+    separation       how far below the controls the patients are: minus the mean z-score of the
+                     patients' scores against the controls' linear trend with age
+    progression_t    t statistic of the within-series (cohort) slope of the patients' scores,
+                     i.e. how clearly the score tracks the change over time (negative for thinning)
+"""
+import numpy as np
+
+from oct_utils.trajectory import TrajectoryModel
+
+NORMALIZATIONS = ["zscore", "max", "log"]
+DEFAULT_ROD_FRACTIONS = np.linspace(0.0, 1.0, 11)
+DEFAULT_RANGES = [(1, 100), (2, 100), (5, 100), (10, 100), (25, 100), (50, 100)]
+SWEEP_METRICS = ["separation", "progression_t"]
+
+
+def normalize_density(density: np.ndarray, normalization: str) -> np.ndarray:
+    """ Normalize a density map (..., 8, 8) over its last two axes. """
+    density = np.asarray(density, dtype=float)
+    if normalization == "log":
+        # the log compresses the steep foveal peak of the cones (and there are no rods at the very center)
+        density = np.log1p(density)
+        normalization = "zscore"
+    if normalization == "zscore":
+        # as z_normalize_df: standardized over all cells, the ones below the mean set to 0
+        mean = density.mean(axis=(-2, -1), keepdims=True)
+        std = density.std(axis=(-2, -1), keepdims=True)
+        return np.maximum((density - mean) / std, 0.0)
+    if normalization == "max":
+        return density / density.max(axis=(-2, -1), keepdims=True)
+    raise ValueError(f"Unrecognized normalization: {normalization}")
+
+
+def sweep_weight_maps(rods: np.ndarray, cones: np.ndarray, normalizations: list[str] = NORMALIZATIONS,
+                      rod_fractions=DEFAULT_ROD_FRACTIONS,
+                      ranges: list[tuple[float, float]] = DEFAULT_RANGES) -> tuple[list[dict], np.ndarray]:
+    """
+    All candidate weight maps of the grid.
+
+    Parameters:
+    -----------
+    rods, cones : array
+        density maps (8, 8), per sq mm
+    normalizations : list
+        any of NORMALIZATIONS
+    rod_fractions : array
+        the rod fractions f of the mix (the cones get 1 - f)
+    ranges : list
+        (low, high) of the rescaled weights
+
+    Returns:
+    --------
+    (list, array)
+        the parameters of each candidate, and the candidates (C, 8, 8), as integers like the stored weights;
+        the candidates that come out constant (nothing to rescale) are left out
+    """
+    normalized = np.stack([np.stack([normalize_density(rods, normalization), normalize_density(cones, normalization)])
+                           for normalization in normalizations])                        # (K, 2, 8, 8)
+    fractions = np.asarray(rod_fractions, dtype=float)[None, :, None, None]             # (1, M, 1, 1)
+    mixed = fractions * normalized[:, None, 0] + (1 - fractions) * normalized[:, None, 1]  # (K, M, 8, 8)
+    lowest = mixed.min(axis=(-2, -1), keepdims=True)
+    spread = mixed.max(axis=(-2, -1), keepdims=True) - lowest
+    with np.errstate(invalid="ignore", divide="ignore"):
+        unit = (mixed - lowest) / spread                                                 # (K, M, 8, 8) in [0, 1]
+    (low, high) = np.asarray(ranges, dtype=float).T
+    candidates = low[:, None, None] + unit[:, :, None] * (high - low)[:, None, None]      # (K, M, R, 8, 8)
+    # stored as whole numbers (see create_weights_map), so they are scored as such
+    candidates = np.floor(candidates).reshape(-1, *mixed.shape[-2:])
+
+    parameters = [{"normalization": normalization, "rod_fraction": round(float(fraction), 6),
+                   "range_low": low_i, "range_high": high_i}
+                  for normalization in normalizations for fraction in np.ravel(rod_fractions)
+                  for (low_i, high_i) in ranges]
+    usable = ~np.isnan(candidates).any(axis=(-2, -1))
+    return [p for p, ok in zip(parameters, usable) if ok], candidates[usable]
+
+
+def batch_scores(maps: np.ndarray, weight_maps: np.ndarray) -> np.ndarray:
+    """
+    Weighted average thickness of every scan under every weight map: (N, C),
+    the same as weighted_avg_stack for each map, but as two matrix products.
+    """
+    maps = np.asarray(maps, dtype=float).reshape(len(maps), -1)
+    weight_maps = np.asarray(weight_maps, dtype=float).reshape(len(weight_maps), -1)
+    valid = ~np.isnan(maps)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (np.where(valid, maps, 0.0) @ weight_maps.T) / (valid.astype(float) @ weight_maps.T)
+
+
+def separation(control_scores: np.ndarray, control_ages: np.ndarray,
+               patient_scores: np.ndarray, patient_ages: np.ndarray) -> np.ndarray:
+    """ (C,) minus the mean z-score of the patients against the controls' linear age trend of each score. """
+    complete = ~np.isnan(control_scores).any(axis=1)  # scans without any map to score
+    (control_scores, control_ages) = (control_scores[complete], control_ages[complete])
+    design = np.column_stack([np.ones(len(control_ages)), control_ages])
+    coefficients = np.linalg.lstsq(design, control_scores, rcond=None)[0]               # (2, C)
+    residuals = control_scores - design @ coefficients
+    sd = np.sqrt(np.sum(residuals ** 2, axis=0) / max(len(control_ages) - 2, 1))
+    expected = np.column_stack([np.ones(len(patient_ages)), patient_ages]) @ coefficients
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return -np.nanmean((patient_scores - expected) / sd, axis=0)
+
+
+def progression_t(scores: np.ndarray, ages: np.ndarray, series_labels: list) -> np.ndarray:
+    """ (C,) t statistic of the cohort (within-series) slope of each score. """
+    model = TrajectoryModel().fit(ages, scores, series_labels)
+    residuals = scores - model.predict(ages, series_labels)
+    dof = len(ages) - len(model.series) - 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sxx = np.nansum(np.where(model.n >= 2, model.sum_tt - model.sum_t ** 2 / model.n, 0.0), axis=0)
+        residual_sd = np.sqrt(np.nansum(residuals ** 2, axis=0) / max(dof, 1))
+        return model.cohort_slope * np.sqrt(sxx) / residual_sd
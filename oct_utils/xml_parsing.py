@@ -1,5 +1,7 @@
 import xml.etree.ElementTree as ET
+import numpy as np
 from oct_utils.data_structures import PosteriorPoleData
+from oct_utils.thickness_grids import POSTERIOR_POLE_GRID_NAME, parse_thickness_grids
 from datetime import datetime
 
 
@@ -132,8 +134,21 @@ def extract_meta_data(tree: ET, xmlfile: str, debug=False) -> list[str] | None:
 
 
 def extract_pp_map(xmlfile, debug=False) -> PosteriorPoleData | None:
-
     tree = ET.parse(xmlfile)
+    return extract_pp_map_from_tree(tree, xmlfile, debug=debug)
+
+
+def extract_pp_map_from_bytes(xml_bytes: bytes, xmlfile: str, debug=False) -> PosteriorPoleData | None:
+    """ Same as extract_pp_map, but parses the content already read into memory,
+        so the caller can hash and parse the file from a single read. """
+    tree = ET.ElementTree(ET.fromstring(xml_bytes))
+    return extract_pp_map_from_tree(tree, xmlfile, debug=debug)
+
+
+def extract_pp_map_from_tree(tree: ET.ElementTree, xmlfile: str, debug=False) -> PosteriorPoleData | None:
+    # (pandas is imported here, rather than at the top, to keep it out of the processes that never parse)
+    import pandas as pd
+
     metadata = extract_meta_data(tree, xmlfile)
     if metadata is None: return None
     [laterality, alias, age_at_test, tot_vol] = metadata
@@ -144,29 +159,19 @@ def extract_pp_map(xmlfile, debug=False) -> PosteriorPoleData | None:
     ppd.age_at_test  = age_at_test
     ppd.total_volume = tot_vol  # this might be None
 
-    pp_grid_found = False
-    for grid in tree.findall(".//ThicknessGrid"):
-        grid_name = grid.find('Name').text
-        if grid_name != "8x8 Posterior Pole Grid": continue
-        if debug: print(grid_name)
-        for zone in grid.findall("./Zone"):
-            pp_grid_found = True
-            zone_name = zone.find('Name').text
-            zone_thck = zone.find('AvgThickness').text
-            if zone_thck is None: continue
-            zone_thck = float(zone_thck)
-
-            zone_valid_pctg = float(zone.find('ValidPixelPercentage').text)
-
-            row = int(zone_name[0]) - 1
-            col = int(zone_name[2]) - 1
-            if debug: print(f" {row} {col} {zone_name}  {zone_thck}  {zone_valid_pctg}")
-            ppd.pp_map.loc[row, col]  = zone_thck
-            ppd.weights.loc[row, col] = zone_valid_pctg
-
-    if not pp_grid_found:
+    # all grids are kept, so that the other grids (e.g. ETDRS) never need the xml again
+    ppd.thickness_grids = parse_thickness_grids(tree)
+    pp_grid = ppd.thickness_grids.get(POSTERIOR_POLE_GRID_NAME)
+    if pp_grid is None:
         print(f"Warning: no post pole grid found in {xmlfile}")
         return None
+    if pp_grid.shape != (8, 8):
+        print(f"Warning: unexpected post pole grid shape {pp_grid.shape} in {xmlfile}")
+        return None
+    if debug: print(pp_grid)
 
-    return ppd
+    ppd.pp_map = pd.DataFrame(pp_grid.thickness)
+    # the zones without a thickness keep the default valid pixel percentage
+    ppd.weights = pd.DataFrame(np.where(np.isnan(pp_grid.thickness), 100.0, pp_grid.valid_pct))
 
+    return ppd
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+"""
+Run the OCT analysis as one pipeline: the numbered scripts' stages, as a DAG,
+with the stages that are up to date skipped, and the independent ones run side by side.
+
+    ./run_pipeline.py --list
+    ./run_pipeline.py --xml-dir /path/to/xml --scratch-dir /path/to/scratch
+    ./run_pipeline.py score:patients --force score:patients
+    ./run_pipeline.py --resume          # after a crash: keep the series already stored
+    ./run_pipeline.py --qc              # drop the scans failing quality control
+"""
+import argparse
+import importlib
+import os
+
+from oct_utils.pipeline import FAILED, BLOCKED, Pipeline, Stage
+
+DATA_GROUPS = ["controls", "patients"]
+DENSITY_SHEETS = ["Rods per sq mm", "Cones per sq mm"]
+CELL_SIZE_MM = 0.86
+CELLS_PER_SIDE = 8
+
+# the numbered scripts cannot be imported with the import statement
+interpolate_script = importlib.import_module("02_interpolate")
+visualize_script = importlib.import_module("03_visualize")
+radial_script = importlib.import_module("06_pr_radial_to_8x8_map")
+weights_script = importlib.import_module("07_pr_desnity_to_weights")
+score_script = importlib.import_module("08_score")
+
+
+def build_stages(top_level_dir: str, scratch_dir: str, data_groups: list[str] = DATA_GROUPS,
+                 resume: bool = False, n_workers: int | None = None, qc: bool = False,
+                 qc_choroid: bool = False) -> list[Stage]:
+    # n_workers: the process pools inside the interpolation and scoring stages (default: one process per CPU)
+    # qc, qc_choroid: see 02_interpolate.interpolate_group; unlike the options, a change re-runs the interpolation
+    stages = []
+    for data_group in data_groups:
+        group_kwargs = {"top_level_dir": top_level_dir, "scratch_dir": scratch_dir, "data_group": data_group}
+        db_path = f"{scratch_dir}/oct_results.{data_group}.sqlite"
+        stages.append(Stage(f"interpolate:{data_group}", interpolate_script.interpolate_group,
+                            {**group_kwargs, "qc": qc, "qc_choroid": qc_choroid},
+                            inputs=[f"{top_level_dir}/{data_group}"],
+                            outputs=[db_path, f"{scratch_dir}/qc_rejections.{data_group}.xlsx"],
+                            options={"resume": resume, "n_workers": n_workers}))
+        stages.append(Stage(f"visualize:{data_group}", visualize_script.visualize_group, group_kwargs,
+                            outputs=[f"{scratch_dir}/pp_visualization/{data_group}"],
+                            depends_on=[f"interpolate:{data_group}"]))
+        stages.append(Stage(f"thumbnails:{data_group}", visualize_script.thumbnail_group, group_kwargs,
+                            outputs=[f"{scratch_dir}/pp_thumbnails/{data_group}"],
+                            depends_on=[f"interpolate:{data_group}"]))
+        stages.append(Stage(f"score:{data_group}", score_script.score_group, group_kwargs,
+                            # the pick of 07_pr_desnity_to_weights --sweep --write-best, if any, takes the place
+                            # of the physiological weights (see oct_utils.stats.physiological_weights)
+                            inputs=["data/physiological_weights.json", "data/selected_weights.json"],
+                            outputs=[f"{scratch_dir}/avg_retinal_thickness.{data_group}.xlsx"],
+                            depends_on=[f"interpolate:{data_group}", "physiological_weights"],
+                            options={"n_workers": n_workers}))
+
+    if set(DATA_GROUPS).issubset(data_groups):
+        stages.append(Stage("normative_reference", score_script.build_normative_reference,
+                            {"scratch_dir": scratch_dir},
+                            outputs=[f"{scratch_dir}/normative_reference.npz"],
+                            depends_on=["interpolate:controls"]))
+        stages.append(Stage("compare_groups", score_script.compare_groups,
+                            {"scratch_dir": scratch_dir, "show": False},
+                            outputs=[f"{scratch_dir}/normative_zscores.patients.xlsx",
+                                     f"{scratch_dir}/avg_thckns.png"],
+                            depends_on=["normative_reference", "score:controls", "score:patients"]))
+
+    # photoreceptor densities -> weights; paths relative to the repo, as in the scripts
+    density_csvs = []
+    for sheet_name in DENSITY_SHEETS:
+        base_name = sheet_name.lower().replace(' ', '_')
+        density_csvs.append(f"data/{base_name}.csv")
+        stages.append(Stage(f"radial_to_grid:{base_name}", radial_script.interpolate,
+                            {"shet_name": sheet_name, "cell_size_mm": CELL_SIZE_MM,
+                             "cells_per_side": CELLS_PER_SIDE, "plot": False},
+                            inputs=["data/curcio_ref_pr_densities.xls"], outputs=[f"data/{base_name}.csv"]))
+    stages.append(Stage("physiological_weights", weights_script.densities_to_weights,
+                        {"cell_size_mm": CELL_SIZE_MM, "cells_per_side": CELLS_PER_SIDE, "plot": False},
+                        outputs=["data/physiological_weights.json"],
+                        depends_on=[f"radial_to_grid:{sheet_name.lower().replace(' ', '_')}"
+                                    for sheet_name in DENSITY_SHEETS]))
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("stages", nargs="*", help="stages to run, with their dependencies (default: all)")
+    parser.add_argument("--xml-dir", default="/media/ivana/portable/ush2a/oct/xml")
+    parser.add_argument("--scratch-dir", default="/home/ivana/scratch/ush2a_oct")
+    parser.add_argument("--groups", nargs="+", default=DATA_GROUPS, choices=DATA_GROUPS)
+    parser.add_argument("--force", nargs="*", default=None,
+                        help="re-run these stages even if up to date (no names: all selected stages)")
+    parser.add_argument("--workers", type=int, default=None, help="number of stages running at the same time; they share the CPUs")
+    parser.add_argument("--list", action="store_true", help="show the stages and whether they need to run")
+    parser.add_argument("--resume", action="store_true",
+                        help="interpolation skips the series stored by an earlier (interrupted) run")
+    parser.add_argument("--qc", action="store_true", help="drop the scans failing quality control")
+    parser.add_argument("--qc-choroid", action="store_true",
+                        help="with --qc, also drop the scans whose choroid_ok flag is off")
+    args = parser.parse_args()
+
+    # the CPUs are shared among the stages running side by side (by default, one per data group),
+    # so that the process pools inside the stages do not add up to several processes per CPU
+    stage_workers = max(1, (os.cpu_count() or 1) // (args.workers or len(args.groups)))
+    pipeline = Pipeline(build_stages(args.xml_dir, args.scratch_dir, args.groups, args.resume, stage_workers,
+                                     args.qc, args.qc_choroid),
+                        state_dir=args.scratch_dir)
+    force = False if args.force is None else (args.force or True)
+
+    if args.list:
+        for name, needs_run in pipeline.plan(args.stages or None, force).items():
+            print(f"{name:40s} {'needs to run' if needs_run else 'up to date'}")
+        return
+
+    statuses = pipeline.run(args.stages or None, force=force, max_workers=args.workers)
+    for name, status in statuses.items():
+        print(f"{name:40s} {status}")
+    if any(status in (FAILED, BLOCKED) for status in statuses.values()):
+        exit(1)
+
+
+#######################
+if __name__ == "__main__":
+    main()
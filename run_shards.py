@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+"""
+Sharded runs of the interpolation and scoring stages: the aliases are split into shards
+(see oct_utils.sharding), and any number of workers, on any number of machines sharing
+the scratch directory, take the shards from a common work queue. The merge then puts
+the shards together into the same stores and reports a single-node run produces.
+
+    ./run_shards.py init --n-shards 16 --xml-dir /path/to/xml --scratch-dir /path/to/scratch
+    ./run_shards.py work --scratch-dir /path/to/scratch      # on each node, as many as needed
+    ./run_shards.py merge --scratch-dir /path/to/scratch     # once all shards are done
+    ./run_shards.py local --n-shards 8 --workers 4           # all of the above, on this machine
+"""
+import argparse
+import importlib
+import json
+import os
+import time
+from multiprocessing import Process
+
+import pandas as pd
+
+from oct_utils.result_store import ResultStore
+from oct_utils.sharding import (CLAIMED, DEFAULT_LEASE_SECONDS, DONE, LeaseKeeper, LeaseLost, WorkQueue,
+                                default_worker_name, parse_shard_item, shard_item)
+
+DATA_GROUPS = ["controls", "patients"]
+SHARD_DIR_NAME = "shards"
+
+# the numbered scripts cannot be imported with the import statement
+interpolate_script = importlib.import_module("02_interpolate")
+score_script = importlib.import_module("08_score")
+
+
+def shard_root(scratch_dir: str) -> str:
+    return f"{scratch_dir}/{SHARD_DIR_NAME}"
+
+
+def shard_scratch_dir(scratch_dir: str, shard: int) -> str:
+    """ Each shard writes the same files as a single-node run would, in a scratch directory of its own. """
+    return f"{shard_root(scratch_dir)}/shard{shard:03d}"
+
+
+def load_config(scratch_dir: str) -> dict:
+    with open(f"{shard_root(scratch_dir)}/config.json") as inf:
+        return json.load(inf)
+
+
+def work_queue(scratch_dir: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> WorkQueue:
+    return WorkQueue(f"{shard_root(scratch_dir)}/work_queue.sqlite", lease_seconds=lease_seconds)
+
+
+###########################
+def init(xml_dir: str, scratch_dir: str, n_shards: int, data_groups: list[str] = DATA_GROUPS,
+         qc: bool = False, qc_choroid: bool = False):
+    os.makedirs(shard_root(scratch_dir), exist_ok=True)
+    config_path = f"{shard_root(scratch_dir)}/config.json"
+    if os.path.exists(config_path) and load_config(scratch_dir)["n_shards"] != n_shards:
+        raise ValueError(f"{config_path} was set up with a different number of shards")
+    with open(config_path, "w") as outf:
+        json.dump({"xml_dir": xml_dir, "n_shards": n_shards, "data_groups": data_groups,
+                   "qc": qc, "qc_choroid": qc_choroid}, outf)
+    number_added = work_queue(scratch_dir).add([shard_item(data_group, shard)
+                                                for data_group in data_groups for shard in range(n_shards)])
+    print(f"{number_added} work items added to the queue in {shard_root(scratch_dir)}")
+
+
+def process_item(item: str, config: dict, scratch_dir: str, n_workers: int | None = None,
+                 lease: LeaseKeeper | None = None):
+    (data_group, shard) = parse_shard_item(item)
+    shard_dir = shard_scratch_dir(scratch_dir, shard)
+    os.makedirs(shard_dir, exist_ok=True)
+    # a worker that has lost the lease stops writing into the shard: another worker has it now
+    if lease is not None: lease.check()
+    # resume: a shard taken over from a worker that died goes on from that worker's last checkpoint
+    interpolate_script.interpolate_group(config["xml_dir"], shard_dir, data_group, resume=True,
+                                         shard=(shard, config["n_shards"]), n_workers=n_workers,
+                                         qc=config.get("qc", False), qc_choroid=config.get("qc_choroid", False))
+    if lease is not None: lease.check()
+    score_script.score_group(config["xml_dir"], shard_dir, data_group, reports=False, n_workers=n_workers)
+
+
+def work(scratch_dir: str, worker: str | None = None, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+         n_workers: int | None = None) -> int:
+    """
+    Process shards until there are none left; returns the number processed by this worker.
+    n_workers: processes used for each shard (default: one per CPU)
+    """
+    config = load_config(scratch_dir)
+    queue = work_queue(scratch_dir, lease_seconds)
+    if worker is None: worker = default_worker_name()
+    number_done = 0
+    while True:
+        item = queue.claim(worker)
+        if item is None:
+            # nothing to claim; wait if some other worker may still die and leave its item behind
+            if CLAIMED not in queue.statuses().values(): break
+            time.sleep(min(lease_seconds / 10, 30.0))
+            continue
+        print(f"{worker}: processing {item}")
+        try:
+            with queue.keep_alive(item, worker) as lease:
+                process_item(item, config, scratch_dir, n_workers, lease)
+                lease.check()
+        except LeaseLost as e:
+            print(f"Warning: {e}, its result is discarded")
+            continue
+        except Exception as e:
+            print(f"Warning: {worker}: {item} failed: {e!r}")
+            queue.fail(item, worker, repr(e))
+            continue
+        if not queue.complete(item, worker):
+            print(f"Warning: {worker} lost the lease on {item}, its result is discarded")
+            continue
+        number_done += 1
+    print(f"{worker}: done, {number_done} shards processed")
+    return number_done
+
+
+def merge(scratch_dir: str):
+    config = load_config(scratch_dir)
+    statuses = work_queue(scratch_dir).statuses()
+    unfinished = sorted(item for item, status in statuses.items() if status != DONE)
+    if unfinished:
+        raise Exception(f"Shards not done: {', '.join(unfinished)}")
+
+    for data_group in config["data_groups"]:
+        db_path = f"{scratch_dir}/oct_results.{data_group}.sqlite"
+        tmp_path = f"{db_path}.merging"
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        qc_reports = []
+        with ResultStore(tmp_path) as store:
+            for shard in range(config["n_shards"]):
+                shard_dir = shard_scratch_dir(scratch_dir, shard)
+                store.merge_from(f"{shard_dir}/oct_results.{data_group}.sqlite")
+                qc_reports.append(pd.read_excel(f"{shard_dir}/qc_rejections.{data_group}.xlsx", index_col=0))
+            print(f"{data_group}: {store.count()} scans merged from {config['n_shards']} shards")
+        os.replace(tmp_path, db_path)
+        pd.concat(qc_reports, ignore_index=True).to_excel(f"{scratch_dir}/qc_rejections.{data_group}.xlsx")
+        score_script.write_score_reports(scratch_dir, data_group)
+
+    if set(DATA_GROUPS).issubset(config["data_groups"]):
+        score_script.build_normative_reference(scratch_dir)
+        score_script.compare_groups(scratch_dir, show=False)
+
+
+def local(xml_dir: str, scratch_dir: str, n_shards: int, n_workers: int, data_groups: list[str] = DATA_GROUPS,
+          lease_seconds: float = DEFAULT_LEASE_SECONDS, qc: bool = False, qc_choroid: bool = False):
+    """ Queue, workers and merge on this machine - the workers are separate processes, as on separate nodes. """
+    init(xml_dir, scratch_dir, n_shards, data_groups, qc, qc_choroid)
+    # the workers share the CPUs
+    processes_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+    workers = [Process(target=work, args=(scratch_dir, f"local-{i}", lease_seconds, processes_per_worker))
+               for i in range(n_workers)]
+    for process in workers: process.start()
+    for process in workers: process.join()
+    merge(scratch_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["init", "work", "merge", "local"])
+    parser.add_argument("--xml-dir", default="/media/ivana/portable/ush2a/oct/xml")
+    parser.add_argument("--scratch-dir", default="/home/ivana/scratch/ush2a_oct")
+    parser.add_argument("--groups", nargs="+", default=DATA_GROUPS, choices=DATA_GROUPS)
+    parser.add_argument("--n-shards", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2, help="number of local worker processes (local only)")
+    parser.add_argument("--worker-name", default=None, help="default: host name and process id")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="processes of a worker (work only; default: one per CPU)")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                        help="seconds before the shard of a silent worker is given to another one")
+    parser.add_argument("--qc", action="store_true", help="drop the scans failing quality control (init, local)")
+    parser.add_argument("--qc-choroid", action="store_true",
+                        help="with --qc, also drop the scans whose choroid_ok flag is off (init, local)")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        init(args.xml_dir, args.scratch_dir, args.n_shards, args.groups, args.qc, args.qc_choroid)
+    elif args.command == "work":
+        work(args.scratch_dir, args.worker_name, args.lease, args.processes)
+    elif args.command == "merge":
+        merge(args.scratch_dir)
+    else:
+        local(args.xml_dir, args.scratch_dir, args.n_shards, args.workers, args.groups, args.lease,
+              args.qc, args.qc_choroid)
+
+
+#######################
+if __name__ == "__main__":
+    main()